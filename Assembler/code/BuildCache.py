@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+Source hash -> Output files
+Content-addressed build cache shared by the assembler and the VM translator
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+import os, json, shutil, hashlib, logging
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nand2tetris')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+EVICT_TO = 0.75 #fraction of max_bytes an eviction leaves
+USAGE_FILE = 'usage' #running total of the entries' size, so a store need not walk the cache
+
+def file_digest(path):
+    """
+    File -> String
+    Returns the sha256 of a file's contents, read in blocks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as reader:
+        for block in iter(lambda: reader.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class BuildCache(object):
+    """
+    Stores output files under a hash of the tool, its version, its options and its inputs.
+    The least recently used entries are evicted once the cache grows past max_bytes
+    >>> import tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> cache = BuildCache(os.path.join(tmp, 'cache'), max_bytes=100)
+    >>> out = os.path.join(tmp, 'Max.hack')
+    >>> key = cache.key('assembler', '1.0', {'binary': False}, 'abc')
+    >>> cache.restore(key, [out])
+    False
+    >>> with open(out, 'w') as writer:
+    ...     _ = writer.write('0000000000000010')
+    >>> cache.store(key, [out])
+    >>> os.remove(out)
+    >>> cache.restore(key, [out]), open(out).read()
+    (True, '0000000000000010')
+    >>> key == cache.key('assembler', '1.0', {'binary': True}, 'abc')
+    False
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or os.environ.get('NAND2TETRIS_CACHE', DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+
+    def key(self, tool, version, options, *digests):
+        """
+        String, String, Dict, Strings -> String
+        """
+        digest = hashlib.sha256(json.dumps([tool, version, options], sort_keys=True).encode())
+        for source_digest in digests:
+            digest.update(source_digest.encode())
+        return digest.hexdigest()
+
+    def entry(self, key, path):
+        """
+        Cache file holding the output of key with the same extension as path
+        """
+        return os.path.join(self.directory, key[:2], key + os.path.splitext(path)[1])
+
+    def restore(self, key, paths):
+        """
+        String, List of Strings -> Boolean
+        Copies every cached output for key to its path; False on a miss, including an entry that another
+        process evicts before it is copied
+        """
+        entries = [self.entry(key, path) for path in paths]
+        try:
+            for entry, path in zip(entries, paths):
+                shutil.copyfile(entry, path)
+                os.utime(entry) #mark as recently used
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, paths):
+        """
+        String, List of Strings -> None
+        Copies freshly built outputs into the cache. The cache is only walked and evicted when the running
+        total of its size passes max_bytes
+        """
+        try:
+            added = 0
+            for path in paths:
+                entry = self.entry(key, path)
+                os.makedirs(os.path.dirname(entry), exist_ok=True)
+                tmp = f'{entry}.{os.getpid()}.tmp'
+                shutil.copyfile(path, tmp)
+                added += os.path.getsize(tmp)
+                os.replace(tmp, entry)
+            usage = self.usage()
+            if usage is None or usage + added > self.max_bytes:
+                self.evict()
+            else:
+                self.set_usage(usage + added)
+        except OSError:
+            logging.exception('Could not write to the build cache.')
+
+    def usage(self):
+        """
+        None -> Int or None
+        The running total of the cache's size, None if it has not been counted yet. Stores from concurrent
+        processes can each miss the other's update, so it is approximate; evict counts it again
+        """
+        try:
+            with open(os.path.join(self.directory, USAGE_FILE), 'r') as reader:
+                return int(reader.read())
+        except (OSError, ValueError):
+            return None
+
+    def set_usage(self, total):
+        """
+        Int -> None
+        """
+        path = os.path.join(self.directory, USAGE_FILE)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as writer:
+            writer.write(str(total))
+        os.replace(tmp, path)
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in EVICT_TO of max_bytes, so it is not walked
+        again on the next store, and records the size left. Files another process is writing or removing
+        are left alone
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith('.tmp') or file == USAGE_FILE:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, file))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self.set_usage(total)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+ROM address -> asm line -> VM file, line and function
+Source map shared by the assembler and the VM translator, and read by the CPU emulator to say where code came from
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+import json
+from array import array
+from bisect import bisect_right
+
+MAP_FORMAT = 1
+
+def shape(lines):
+    """
+    Iterable of Strings -> List of (Int, Int), Int, Int
+    The runs of a piece of assembly as (instruction, line) offsets from its start, one where the next
+    instruction is not on the next line, then the number of instructions and of lines. Instructions are
+    counted as lex counts them: every line but blanks, comments and labels
+    >>> shape(['//push constant 7', '@7', 'D=A', '(LOOP)', '@LOOP', '0;JMP', ''])
+    ([(0, 1), (2, 4)], 4, 7)
+    """
+    runs = []
+    words = count = 0
+    for count, line in enumerate(lines, 1):
+        if '//' in line:
+            line = line[:line.index('//')]
+        line = line.strip()
+        if line and line[0] != '(':
+            if not runs or count - 1 - words != runs[-1][1] - runs[-1][0]:
+                runs.append((words, count - 1))
+            words += 1
+    return runs, words, count
+
+class SourceMap(object):
+    """
+    Where each ROM address came from, as a sorted array of the first address of every run of instructions on
+    consecutive asm lines with one origin, so a lookup is one bisect. An origin is a (VM file, VM line, function)
+    tuple, or None for code with no VM source (the startup code, or anything the assembler maps on its own).
+    A map is built in program order, one piece of assembly at a time, as the pieces are written
+    >>> source_map = SourceMap()
+    >>> source_map.add_piece('//Startup code\\n@256\\nD=A\\n')
+    >>> source_map.add_piece('\\n//push constant 7\\n@7\\nD=A\\n', ('Main.vm', 3, 'Main.main'))
+    >>> source_map.add_piece('\\n//label LOOP\\n(Main.main$LOOP)\\n', ('Main.vm', 4, 'Main.main'))
+    >>> source_map.add_piece('\\n//goto LOOP\\n@Main.main$LOOP\\n0;JMP\\n', ('Main.vm', 5, 'Main.main'))
+    >>> [source_map.lookup(address) for address in (1, 3, 4)]
+    [(3, None), (7, ('Main.vm', 3, 'Main.main')), (13, ('Main.vm', 5, 'Main.main'))]
+    >>> source_map.words, len(source_map.addresses)
+    (6, 3)
+    """
+    __slots__ = ('addresses', 'lines', 'origins', 'words', 'line_count', 'shapes')
+
+    def __init__(self):
+        self.addresses = array('L')
+        self.lines = array('L') #asm line of the first instruction of each run
+        self.origins = []
+        self.words = 0 #instructions mapped so far
+        self.line_count = 0 #asm lines before the next piece
+        self.shapes = {}
+
+    def add(self, address, line, origin=None):
+        """
+        Int, Int, Tuple or None -> None
+        Starts a run at address, unless it carries on the last one
+        """
+        if self.origins and origin == self.origins[-1] and line - address == self.lines[-1] - self.addresses[-1]:
+            return
+        self.addresses.append(address)
+        self.lines.append(line)
+        self.origins.append(origin)
+
+    def add_piece(self, text, origin=None):
+        """
+        String, Tuple or None -> None
+        Maps the next piece of the program, which starts on the line the piece before it ends on.
+        Pieces that repeat, like the VM translator's templates, are only scanned once
+        """
+        try:
+            runs, words, lines = self.shapes[text]
+        except KeyError:
+            runs, words, lines = self.shapes[text] = shape(text.split('\n'))
+        for word, line in runs:
+            self.add(self.words + word, self.line_count + line + 1, origin)
+        self.words += words
+        self.line_count += lines - 1
+
+    def add_lines(self, lines, origin=None):
+        """
+        Iterable of Strings -> None
+        Maps a whole .asm, read as lines; the assembler's map of a file is just this
+        """
+        runs, words, count = shape(lines)
+        for word, line in runs:
+            self.add(self.words + word, self.line_count + line + 1, origin)
+        self.words += words
+        self.line_count += count
+
+    def extend(self, other):
+        """
+        SourceMap -> None
+        Appends a map built on its own, as a worker process builds the map of one file
+        """
+        for address, line, origin in zip(other.addresses, other.lines, other.origins):
+            self.add(self.words + address, self.line_count + line, origin)
+        self.words += other.words
+        self.line_count += other.line_count
+
+    def lookup(self, address):
+        """
+        Int -> (Int, Tuple or None) or None
+        The asm line and origin of the instruction at address; None outside the program
+        """
+        if not 0 <= address < self.words:
+            return None
+        run = bisect_right(self.addresses, address) - 1
+        return self.lines[run] + address - self.addresses[run], self.origins[run]
+
+    def describe(self, address):
+        """
+        Int -> String
+        >>> source_map = SourceMap()
+        >>> source_map.add_piece('@7\\nD=A\\n', ('Main.vm', 3, 'Main.main'))
+        >>> source_map.describe(1), source_map.describe(2)
+        ('Main.vm:3 in Main.main (asm line 2)', 'outside the program')
+        """
+        found = self.lookup(address)
+        if found is None:
+            return 'outside the program'
+        line, origin = found
+        if origin is None:
+            return f'asm line {line}'
+        file, vm_line, function = origin
+        return f"{file}:{vm_line}{' in ' + function if function else ''} (asm line {line})"
+
+    def __getstate__(self):
+        #a worker's map goes back to the parent without its scanned shapes
+        return self.addresses, self.lines, self.origins, self.words, self.line_count
+
+    def __setstate__(self, state):
+        self.addresses, self.lines, self.origins, self.words, self.line_count = state
+        self.shapes = {}
+
+    def dump(self, filename):
+        """
+        Writes the map as JSON: each run is [address, asm line], with [VM file, VM line, function] after
+        them when it has an origin. Files and functions are written once each and referred to by index
+        """
+        files, functions = {}, {None: 0}
+        runs = []
+        for address, line, origin in zip(self.addresses, self.lines, self.origins):
+            if origin is None:
+                runs.append([address, line])
+            else:
+                file, vm_line, function = origin
+                runs.append([address, line, files.setdefault(file, len(files)), vm_line,
+                             functions.setdefault(function, len(functions))])
+        with open(filename, 'w') as writer:
+            writer.write(json.dumps({'format': MAP_FORMAT, 'words': self.words, 'lines': self.line_count,
+                                     'files': list(files), 'functions': list(functions), 'runs': runs},
+                                    separators=(',', ':')))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        String -> SourceMap
+        >>> import os, tempfile
+        >>> source_map = SourceMap()
+        >>> source_map.add_piece('//Startup code\\n@256\\n')
+        >>> source_map.add_piece('\\n//pop static 0\\n@SP\\nAM=M-1\\n', ('Main.vm', 9, None))
+        >>> path = os.path.join(tempfile.mkdtemp(), 'Main.map')
+        >>> source_map.dump(path)
+        >>> loaded = SourceMap.load(path)
+        >>> [loaded.lookup(address) for address in range(3)] == [source_map.lookup(address) for address in range(3)]
+        True
+        """
+        with open(filename, 'r') as reader:
+            data = json.load(reader)
+        if data.get('format') != MAP_FORMAT:
+            raise ValueError(f"{filename} is not a source map this version can read")
+        source_map = cls()
+        files, functions = data['files'], data['functions']
+        for run in data['runs']:
+            origin = (files[run[2]], run[3], functions[run[4]]) if len(run) > 2 else None
+            source_map.add(run[0], run[1], origin)
+        source_map.words, source_map.line_count = data['words'], data['lines']
+        return source_map
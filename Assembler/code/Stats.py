@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+Phases and counters -> JSON
+Opt-in timing and counters (--stats) shared by the assembler and the VM translator
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+import json, time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: #not available on Windows
+    resource = None
+
+class Stats(object):
+    """
+    Accumulates seconds per phase and named counters for one run
+    >>> stats = Stats('Max.asm')
+    >>> with stats.phase('read'):
+    ...     stats.count('lines', 3)
+    >>> stats.count('lines', 2)
+    >>> report = stats.report()
+    >>> report['source'], report['counters'], list(report['phases'])
+    ('Max.asm', {'lines': 5}, ['read'])
+    """
+    enabled = True
+
+    def __init__(self, source):
+        self.source = source
+        self.phases = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        """
+        Stats -> None
+        Adds the phases and counters of other, e.g. the Stats of a worker process
+        >>> stats, worker = Stats('Prog'), Stats('Prog/Main.vm')
+        >>> stats.count('lines', 2)
+        >>> worker.count('lines', 3)
+        >>> stats.merge(worker)
+        >>> stats.counters
+        {'lines': 5}
+        """
+        for name, seconds in other.phases.items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def report(self):
+        """
+        None -> Dict
+        Phases, counters, lines per second and peak memory (in KB, where the platform reports it)
+        """
+        elapsed = time.perf_counter() - self.start
+        report = {'source': self.source, 'seconds': round(elapsed, 6),
+                  'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+                  'counters': dict(self.counters)}
+        if 'lines' in self.counters:
+            report['lines_per_second'] = round(self.counters['lines'] / max(elapsed, 1e-9))
+        if resource is not None:
+            report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return report
+
+    def dump(self, writer):
+        """
+        Writes the report as one line of JSON
+        """
+        writer.write(json.dumps(self.report()) + '\n')
+
+class NullStats(object):
+    """
+    Stand-in used when --stats is off: every method is a no-op, so instrumented code costs nothing
+    """
+    enabled = False
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, other):
+        pass
+
+NULL_STATS = NullStats()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+Symbol -> Address
+Symbol table shared by the assembler and the VM translator
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+from itertools import islice
+
+PREDEFINED_SYMBOLS = {
+    'SP':0,
+    'LCL':1,
+    'ARG':2,
+    'THIS':3,
+    'THAT':4,
+    'R0':0,
+    'R1':1,
+    'R2':2,
+    'R3':3,
+    'R4':4,
+    'R5':5,
+    'R6':6,
+    'R7':7,
+    'R8':8,
+    'R9':9,
+    'R10':10,
+    'R11':11,
+    'R12':12,
+    'R13':13,
+    'R14':14,
+    'R15':15,
+    'SCREEN':16384,
+    'KBD':24576
+}
+
+class SymbolTable(object):
+    """
+    Predefined symbols, labels and variables in a single dict, so resolving a symbol is one lookup
+    >>> table = SymbolTable()
+    >>> table.add_label('LOOP', 4)
+    >>> [table.lookup(s) for s in ('LOOP', 'i', 'KBD', 'sum', 'i')]
+    [4, 16, 24576, 17, 16]
+    >>> table.user_symbols()
+    [('LOOP', 4), ('i', 16), ('sum', 17)]
+    """
+    __slots__ = ('symbols', 'var_mem_location')
+
+    def __init__(self):
+        self.symbols = PREDEFINED_SYMBOLS.copy()
+        self.var_mem_location = 16
+
+    def contains(self, symbol):
+        """
+        String -> Boolean
+        """
+        return symbol in self.symbols
+
+    def get_entry(self, symbol):
+        return self.symbols[symbol]
+
+    def add_label(self, symbol, address):
+        """
+        String, Int -> None
+        Predefined symbols win over labels of the same name
+        """
+        if symbol not in PREDEFINED_SYMBOLS:
+            self.symbols[symbol] = address
+
+    def lookup(self, symbol):
+        """
+        String -> Int
+        Returns the address of symbol, allocating the next variable address if it is new
+        """
+        try:
+            return self.symbols[symbol]
+        except KeyError:
+            mem_addr = self.symbols[symbol] = self.var_mem_location
+            self.var_mem_location += 1
+            return mem_addr
+
+    def user_symbols(self):
+        """
+        None -> List of (String, Int)
+        Labels and variables, in the order they were added
+        """
+        return list(islice(self.symbols.items(), len(PREDEFINED_SYMBOLS), None))
+
+    def dump(self, filename):
+        """
+        Writes the labels and variables to a .sym file, one 'symbol address' pair per line
+        """
+        with open(filename, 'w') as writer:
+            writer.writelines(f'{symbol} {mem_addr}\n' for symbol, mem_addr in self.user_symbols())
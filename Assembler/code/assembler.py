@@ -8,164 +8,440 @@ File of Strings -> File of Strings in Binary
 Converts lines of text into lines of binary
 Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
 """
-from io import StringIO
-import sys, os, re, logging
+from array import array
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+import sys, os, glob, time, logging, argparse
+from SymbolTable import SymbolTable
+from SourceMap import SourceMap
+from BuildCache import BuildCache, file_digest
+from Stats import Stats, NULL_STATS
+
+__version__ = '1.0'
+
+DEST_TABLE = {
+    'null':'000',
+    'M':'001',
+    'D':'010',
+    'MD':'011',
+    'A':'100',
+    'AM':'101',
+    'AD':'110',
+    'AMD':'111'
+}
+
+COMP_TABLE = {
+    '0':'101010',
+    '1':'111111',
+    '-1':'111010',
+    'D':'001100',
+    'A':'110000',
+    '!D':'001101',
+    '!A':'110001',
+    '-D':'001111',
+    '-A':'110011',
+    'D+1':'011111',
+    'A+1':'110111',
+    'D-1':'001110',
+    'A-1':'110010',
+    'D+A':'000010',
+    'D-A':'010011',
+    'A-D':'000111',
+    'D&A':'000000',
+    'D|A':'010101'
+}
+
+JUMP_TABLE = {
+    'null':'000',
+    'JGT':'001',
+    'JEQ':'010',
+    'JGE':'011',
+    'JLT':'100',
+    'JNE':'101',
+    'JLE':'110',
+    'JMP':'111'
+}
+
+STREAM_CHUNK_LINES = 65536 #lines read per chunk by assemble_stream
+PARALLEL_CHUNK_LINES = 32768 #lines handed to each worker task by assemble_parallel
+PARALLEL_MIN_LINES = 2 * PARALLEL_CHUNK_LINES #smaller programs are not worth starting a pool for
+
+#bit-field tables, pre-shifted into position so a C-instruction is just 0xE000 | comp | dest | jump
+DEST_BITS = {k: int(v, 2) << 3 for k, v in DEST_TABLE.items()}
+JUMP_BITS = {k: int(v, 2) for k, v in JUMP_TABLE.items()}
+COMP_BITS = {k: int(v, 2) << 6 for k, v in COMP_TABLE.items()}
+COMP_BITS.update({k.replace('A', 'M'): (0b1000000 | int(v, 2)) << 6 for k, v in COMP_TABLE.items() if 'A' in k})
+#commuted spellings of the symmetric operations: A+D, A&D, A|D, M+D, M&D and M|D (the VM translator's M=M+D and
+#D=A+D); other reorderings such as 1+D are not accepted
+COMP_BITS.update({k[::-1]: v for k, v in list(COMP_BITS.items()) if len(k) == 3 and k[1] in '+&|'})
+
+#every dest=comp;jump spelling of the tables above mapped straight to its word, so encoding a C-instruction is one lookup
+C_INSTRUCTIONS = {
+    (comp_part if dest_part == 'null' else dest_part + '=' + comp_part) + ('' if jump_part == 'null' else ';' + jump_part):
+        0xE000 | comp_bits | dest_bits | jump_bits
+    for dest_part, dest_bits in DEST_BITS.items()
+    for comp_part, comp_bits in COMP_BITS.items()
+    for jump_part, jump_bits in JUMP_BITS.items()
+}
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python hack_assembler.py <inputfile.asm>")
+    parser = argparse.ArgumentParser(description="Assembles Hack .asm files into machine code.")
+    parser.add_argument('infiles', nargs='+', metavar='infile',
+                        help="<inputfile.asm>, or a directory or glob of .asm files to assemble in one batch")
+    parser.add_argument('--binary', action='store_true',
+                        help="write raw big-endian 16-bit words to a .bin file instead of a textual .hack file")
+    parser.add_argument('--sym', action='store_true', help="also write the final symbol map to a .sym file")
+    parser.add_argument('--map', action='store_true',
+                        help="also write a source map (.map) from each ROM address to its line in the .asm")
+    parser.add_argument('--stream', action='store_true',
+                        help="assemble in two streaming passes, keeping memory flat regardless of input size")
+    parser.add_argument('--parallel', type=int, metavar='N',
+                        help="lex each program across N worker processes; only pays off for very large programs on several cores")
+    parser.add_argument('--jobs', type=int, metavar='N',
+                        help="assemble up to N files at once in a worker pool")
+    parser.add_argument('--stats', action='store_true',
+                        help="print per-phase timings and counters for each file as a line of JSON")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always assemble, ignoring and not updating the build cache")
+    parser.add_argument('--cache-dir', help="build cache directory (default: $NAND2TETRIS_CACHE or ~/.cache/nand2tetris)")
+    parser.add_argument('--log', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'logs', 'hack_assembler.log'),
+                        help="log file (default: ../logs/hack_assembler.log relative to this script)")
+    args = parser.parse_args()
+    if args.jobs and args.parallel:
+        parser.error("--jobs and --parallel cannot be combined")
+    os.makedirs(os.path.dirname(os.path.abspath(args.log)), exist_ok=True)
+    logging.basicConfig(filename=args.log, level=logging.DEBUG)
+
+    sources = find_sources(args.infiles)
+    options = dict(binary=args.binary, sym=args.sym, map=args.map, stream=args.stream, parallel=args.parallel, stats=args.stats)
+    cache = None if args.no_cache else BuildCache(args.cache_dir)
+    start = time.perf_counter()
+    if args.jobs:
+        with Pool(args.jobs) as pool:
+            results = pool.starmap(assemble_file, [(inf, options, cache) for inf in sources])
     else:
-        logging.basicConfig(filename='../logs/hack_assembler.log', level=logging.DEBUG)
-
-        # read text into memory as a list
-        inf = sys.argv[1]
-        in_text = file_read(inf)
-    
-        # three passes of list, plus symbol assignment
-        filtered_list = first_pass(in_text)
-        symbols = symbol_parse(filtered_list)
-        filtered_list = [line for line in filtered_list if line[0] != "("]
-
-        #iterate thru A and C instructions, convert to binary, continue to build symbols list with variables
-        var_mem_location = 16
-        for line in filtered_list:
-            instruction = commandType(line)
-            try:
-                if instruction == 'A-instruction':
-                    binary_line, symbols, var_mem_location = parse_A(line, symbols, var_mem_location)
-                elif instruction == 'C-instruction':
-                    binary_line = parse_C(line)
-            except Exception:
-                logging.exception('Error in parse function.')
-            
-            out_list = []
-            out_list.append(binary_line)
-
-        #format as string, write to file
-        out_string = '\n'.join(out_list)
-        file_write(out_string)
+        results = [assemble_file(inf, options, cache) for inf in sources]
+    if len(sources) > 1:
+        #with --stats, stdout holds only the per-file JSON lines
+        print_summary(results, time.perf_counter() - start, sys.stderr if args.stats else sys.stdout)
+    if any(count is None for _, count, _ in results):
+        sys.exit(1)
 
-def file_read(inf):
+def find_sources(paths):
     """
-    File -> List of strings
-    Returns list from sys.argv[1]
+    List of Strings -> List of Strings
+    Expands directories (recursively) and glob patterns into a sorted list of .asm files
+    """
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                sources.extend(os.path.join(root, file) for file in files if file.endswith('.asm'))
+        else:
+            sources.extend(glob.glob(path) or [path])
+    return sorted(set(sources))
+
+def assemble_file(inf, options, cache=None):
     """
+    String, Dict -> (String, Int, Float)
+    Assembles one file using the module-level encoding tables, returns its name, word count and seconds taken.
+    The word count is None if the file could not be read, so one bad file does not end a batch.
+    With a cache, an unchanged source assembled with the same options is copied from the cache instead
+    """
+    start = time.perf_counter()
+    stats = Stats(inf) if options.get('stats') else NULL_STATS
+    binary = options.get('binary')
+    outputs = [output_path(inf, binary)]
+    if options.get('sym'):
+        outputs.append(os.path.splitext(inf)[0] + '.sym')
+    if options.get('map'):
+        outputs.append(os.path.splitext(inf)[0] + '.map')
+    table = SymbolTable()
     try:
-        file = open(inf, "r")
-        in_text = file.readlines()
-        return in_text
+        if cache is not None:
+            #the key hashes the source, so a missing file is reported here just as it is without the cache
+            with stats.phase('cache'):
+                key = cache.key('assembler', __version__, {'binary': bool(binary)}, file_digest(inf))
+                hit = cache.restore(key, outputs)
+            if hit:
+                count = word_count(outputs[0], binary)
+                if stats.enabled:
+                    stats.count('cache_hits')
+                    stats.count('words', count)
+                    stats.dump(sys.stdout)
+                return inf, count, time.perf_counter() - start
+
+        if options.get('stream'):
+            count = stream_file(inf, table, binary=binary, stats=stats)
+        else:
+            with stats.phase('read'):
+                in_text = file_read(inf)
+            stats.count('lines', len(in_text))
+            if options.get('parallel'):
+                words = assemble_parallel(in_text, table, options['parallel'], stats)
+            else:
+                # one pass over the text, then a fix-up of symbolic references
+                words = assemble(in_text, table, stats)
+            with stats.phase('write'):
+                file_write(words, inf, binary=binary)
+            count = len(words)
     except FileNotFoundError as fnf_error:
-        print(fnf_error)
-        sys.exit()
-
-def first_pass(in_text):
-    """
-    ListofStrings -> ListofStrings
-    Removes comments(separate lines and in-line) and blank lines from list of strings
-    >>> first_pass(["@43", "//this is a program", "", "M=D", ''])
-    ['@43', 'M=D']
-    >>> first_pass(['', "", "   ", "  @43  "])
-    ['@43']
-    >>> first_pass(["@43", "(LOOP)", "//this is a program", "", "M=D//test", ''])
-    ['@43', '(LOOP)', 'M=D']
-    """
-    comment = "//"
-    filtered_list = [line.split(comment)[0].strip() for line in in_text if line.strip() if line[0:2] != comment]
-    return filtered_list
-
-def symbol_parse(in_text):
-    """
-    List of Strings -> Dict
-    Returns 2x dictionaries of values from parsed list of strings
-    >>> symbol_parse(["(LOOP)", "@i", "M=D", "(STOP)", "@4", "D=A"])
-    {'LOOP': 0, 'STOP': 2}
-    >>> symbol_parse(["@sum", "D=A", "@test", "M=AM", "(LOOP)", "@i", "D=M;JEQ", "@sum", "@i"])
-    {'LOOP': 4}
-    >>> symbol_parse(["@R0", "M;JMP", "(LOOP)", "@i", "M=D", "(STOP)", "@4", "D=A"])
-    {'LOOP': 2, 'STOP': 4}
+        print(fnf_error, file=sys.stderr)
+        logging.error(fnf_error)
+        return inf, None, time.perf_counter() - start
+    if options.get('sym'):
+        with stats.phase('write'):
+            table.dump(outputs[1])
+    if options.get('map'):
+        with stats.phase('map'):
+            map_file(inf, outputs[-1])
+    if cache is not None:
+        with stats.phase('cache'):
+            cache.store(key, outputs)
+    if stats.enabled:
+        stats.count('words', count)
+        stats.count('symbols', len(table.user_symbols()))
+        stats.dump(sys.stdout)
+    return inf, count, time.perf_counter() - start
+
+def map_file(inf, path):
     """
-    symbols = {}
-    lineNumber = 0
-    for line in in_text:
-        if line.startswith("("):
-            symbol = line.strip("()")
-            symbols[symbol] = lineNumber
+    File -> File
+    Writes the source map of inf to path. It is a separate read of the source, so the assembler's passes
+    (streamed, parallel or in memory) cost nothing extra without --map
+    """
+    source_map = SourceMap()
+    with open(inf, 'r') as reader:
+        source_map.add_lines(reader)
+    source_map.dump(path)
+
+def count_kinds(stats, words, labels, refs):
+    """
+    Adds instruction counts by kind to stats; only called when stats are enabled
+    """
+    c_instructions = sum(1 for word in words if word & 0x8000)
+    stats.count('c_instructions', c_instructions)
+    stats.count('a_instructions', len(words) - c_instructions)
+    stats.count('symbolic_references', len(refs))
+    stats.count('labels', len(labels))
+
+def word_count(path, binary=False):
+    """
+    File -> Int
+    Number of words in a .hack or .bin file
+    """
+    if binary:
+        return os.path.getsize(path) // 2
+    with open(path, 'rb') as reader:
+        data = reader.read()
+    return data.count(b'\n') + 1 if data else 0
+
+def print_summary(results, elapsed, writer=sys.stdout):
+    """
+    List of (String, Int, Float), Float, File -> None
+    Prints per-file and aggregate throughput, then the files that failed
+    """
+    failed = [inf for inf, count, _ in results if count is None]
+    for inf, count, seconds in results:
+        if count is None:
+            print(f"{inf}: failed", file=writer)
         else:
-            lineNumber += 1
-    return symbols
+            print(f"{inf}: {count} words in {seconds:.3f}s ({count / max(seconds, 1e-9):,.0f} words/s)", file=writer)
+    total = sum(count for _, count, _ in results if count is not None)
+    print(f"{len(results) - len(failed)} files, {total} words in {elapsed:.3f}s ({total / max(elapsed, 1e-9):,.0f} words/s)",
+          file=writer)
+    if failed:
+        print(f"{len(failed)} failed: {', '.join(failed)}", file=writer)
 
-def commandType(line):
+def file_read(inf):
     """
-    String -> String
-    Determines what type of instruction you wrote (A/C)
-    >>> commandType("@43")
-    'A-instruction'
-    >>> commandType("M=D")
-    'C-instruction'
-    >>> commandType("M = D")
-    'C-instruction'
-    """
-    if line.startswith("@"):
-        instruction = 'A-instruction'
-        return instruction
-    else:
-        instruction = 'C-instruction'
-        return instruction
-
-def parse_A(instruction, symbols, var_mem_location):
-    """
-    String, Dict -> String in binary, Dict
-    Returns A-instruction in binary, updates Dict of symbols
-    >>> parse_A('@3', {}, 16)
-    ('0000000000000011', {}, 16)
-    >>> parse_A('@sum', {'LOOP': 2}, 16)
-    ('0000000000010000', {'LOOP': 2, 'sum': 16}, 17)
-    >>> parse_A('@LOOP', {'END': 10, 'LOOP': 2}, 16)
-    ('0000000000000010', {'END': 10, 'LOOP': 2}, 16)
-    >>> parse_A('@R2', {'LOOP': 2}, 16)
-    ('0000000000000010', {'LOOP': 2}, 16)
-    """
-    predefined_symbols = {
-    'SP':0,
-    'LCL':1,
-    'ARG':2,
-    'THIS':3,
-    'THAT':4,
-    'R0':0,
-    'R1':1,
-    'R2':2,
-    'R3':3,
-    'R4':4,
-    'R5':5,
-    'R6':6,
-    'R7':7,
-    'R8':8,
-    'R9':9,
-    'R10':10,
-    'R11':11,
-    'R12':12,
-    'R13':13,
-    'R14':14,
-    'R15':15,
-    'SCREEN':16384,
-    'KBD':24576
-    }
-    op_code = '0'
-    num = instruction[1:]
+    File -> List of strings
+    Returns the lines of inf
+    """
+    with open(inf, "r") as file:
+        return file.readlines()
 
-    if num.isdigit():
-        mem_addr = int(num)
-    elif num in predefined_symbols.keys():
-        mem_addr = predefined_symbols[num]
-    elif num in symbols.keys():
-        mem_addr = symbols[num]
-    else:
-        symbols[num] = var_mem_location
-        var_mem_location += 1
-        mem_addr = symbols[num]
+def lex(in_text, first_line_no=1):
+    """
+    Iterable of Strings -> Array of words, Dict, List of (Int, String)
+    Reads each line once: drops comments and blank lines, records label addresses, encodes numeric
+    A-instructions and C-instructions, and leaves a placeholder word plus a pending reference for
+    every symbolic A-instruction. Lines that fail to encode are logged and left as a zero word
+    >>> lex(["@43", "//this is a program", "", "M=D", ''])
+    (array('H', [43, 58120]), {}, [])
+    >>> lex(["@sum", "D=A", "@test", "  (LOOP)  ", "@i", "D=M;JEQ//test", "@sum"])
+    (array('H', [0, 60432, 0, 0, 64530, 0]), {'LOOP': 3}, [(0, 'sum'), (2, 'test'), (3, 'i'), (5, 'sum')])
+    >>> lex(["@R0", "M;JMP", "(LOOP)", "@i", "M=D", "(STOP)", "@4", "D=A"])[1]
+    {'LOOP': 2, 'STOP': 4}
+    """
+    words = array('H')
+    labels = {}
+    refs = []
+    c_instruction = C_INSTRUCTIONS.get
+    for line_no, line in enumerate(in_text, first_line_no):
+        if '//' in line:
+            line = line[:line.index('//')]
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if line[0] == '@':
+                num = line[1:]
+                if num.isdigit():
+                    words.append(encode_A(int(num)))
+                else:
+                    refs.append((len(words), sys.intern(num)))
+                    words.append(0)
+            elif line[0] == '(':
+                labels[line.strip('()')] = len(words)
+            else:
+                word = c_instruction(line)
+                words.append(encode_C_unusual(line) if word is None else word)
+        except (KeyError, ValueError):
+            #keep a placeholder word so later addresses match a plain count of instructions
+            logging.exception(f'Error on line {line_no}: {line}')
+            words.append(0)
+    return words, labels, refs
+
+def resolve(words, labels, refs, table=None):
+    """
+    Array of words, Dict, List of (Int, String) -> SymbolTable
+    Fixes up the pending references left by lex, allocating variables from 16 in first-use order,
+    and returns the final symbol table
+    >>> words, labels, refs = lex(["@sum", "(LOOP)", "@i", "@LOOP", "@R2", "@sum"])
+    >>> resolve(words, labels, refs).user_symbols()
+    [('LOOP', 1), ('sum', 16), ('i', 17)]
+    >>> words
+    array('H', [16, 17, 1, 2, 16])
+    """
+    if table is None:
+        table = SymbolTable()
+    for symbol, address in labels.items():
+        table.add_label(symbol, address)
+    lookup = table.lookup
+    for index, num in refs:
+        mem_addr = lookup(num)
+        if mem_addr > 0x7FFF:
+            logging.error(f'A-instruction value out of range: @{num} = {mem_addr}')
+            mem_addr &= 0x7FFF
+        words[index] = mem_addr
+    return table
+
+class Encoder(object):
+    """
+    Encodes a program handed over a piece of text at a time, as lex would encode the pieces joined together,
+    so a producer such as the VM translator never has to write the whole program out as one text.
+    Pieces that repeat, like the VM translator's templates, are lexed once
+    >>> encoder = Encoder()
+    >>> for piece in ("(LOOP)\\n@i\\nM=M+1\\n", "@LOOP\\n0;JMP\\n", "@i\\nM=M+1\\n"):
+    ...     encoder.add(piece)
+    >>> encoder.resolve().user_symbols()
+    [('LOOP', 0), ('i', 16)]
+    >>> encoder.words == assemble(["(LOOP)", "@i", "M=M+1", "@LOOP", "0;JMP", "@i", "M=M+1"])
+    True
+    """
+    __slots__ = ('words', 'labels', 'refs', 'lexed')
+
+    def __init__(self):
+        self.words = array('H')
+        self.labels = {}
+        self.refs = []
+        self.lexed = {}
+
+    def add(self, text):
+        """
+        String -> None
+        """
+        try:
+            lexed = self.lexed[text]
+        except KeyError:
+            lexed = lex(text.splitlines())
+            if not lexed[1]: #a piece defining labels cannot come again, so it is not worth keeping
+                self.lexed[text] = lexed
+        self.extend(*lexed)
+
+    def extend(self, words, labels, refs):
+        """
+        Words, Dict, List of (Int, String) -> None
+        Appends code encoded from address 0, moving its labels and references to where it lands
+        """
+        base = len(self.words)
+        for symbol, address in labels.items():
+            self.labels[symbol] = base + address
+        self.refs.extend((base + index, symbol) for index, symbol in refs)
+        self.words.extend(words)
 
-    rest_code = bin(mem_addr)[2:].zfill(15)
-    return op_code + rest_code, symbols, var_mem_location
+    def resolve(self, table=None):
+        """
+        SymbolTable -> SymbolTable
+        Fixes up every reference once all the pieces are in; see resolve
+        """
+        return resolve(self.words, self.labels, self.refs, table)
+
+def assemble(in_text, table=None, stats=NULL_STATS):
+    """
+    String or Iterable of Strings -> Array of words
+    Assembles a program in one pass plus a fix-up of its symbolic references, entirely in memory
+    >>> assemble(["(LOOP)", "@LOOP", "0;JMP"])
+    array('H', [0, 60039])
+    >>> assemble("@2\\nD=A // two\\n")
+    array('H', [2, 60432])
+    """
+    if isinstance(in_text, str):
+        in_text = in_text.splitlines()
+    with stats.phase('first_pass'):
+        words, labels, refs = lex(in_text)
+    with stats.phase('resolve'):
+        resolve(words, labels, refs, table)
+    if stats.enabled:
+        count_kinds(stats, words, labels, refs)
+    return words
+
+def hack_lines(words):
+    """
+    Array of words -> List of Strings
+    Formats words as the lines of a .hack file
+    >>> hack_lines(assemble("@2\\nD=A"))
+    ['0000000000000010', '1110110000010000']
+    """
+    return [format(word, '016b') for word in words]
+
+def parse_A(instruction, table):
+    """
+    String, SymbolTable -> String in binary
+    Returns A-instruction in binary, allocating a variable in table if the symbol is new
+    >>> table = SymbolTable()
+    >>> table.add_label('LOOP', 2)
+    >>> parse_A('@3', table)
+    '0000000000000011'
+    >>> parse_A('@sum', table)
+    '0000000000010000'
+    >>> parse_A('@LOOP', table)
+    '0000000000000010'
+    >>> parse_A('@R2', table)
+    '0000000000000010'
+    >>> table.user_symbols()
+    [('LOOP', 2), ('sum', 16)]
+    """
+    num = instruction[1:]
+    mem_addr = int(num) if num.isdigit() else table.lookup(num)
+    return format(encode_A(mem_addr), '016b')
+
+def encode_A(mem_addr):
+    """
+    Int -> Int
+    Returns the 16-bit A-instruction word that loads mem_addr
+    >>> encode_A(21)
+    21
+    >>> encode_A(32768)
+    Traceback (most recent call last):
+    ...
+    ValueError: A-instruction value out of range: 32768
+    """
+    if not 0 <= mem_addr <= 0x7FFF:
+        raise ValueError(f'A-instruction value out of range: {mem_addr}')
+    return mem_addr
 
 def parse_C(instruction):
     """
@@ -181,28 +457,43 @@ def parse_C(instruction):
     '1110101010000111'
     >>> parse_C('ADHD=M;JEQ')
     """
-    if ';' not in instruction:
-        instruction += ";null"
-    instruction_split = re.split(r'[;=]', instruction)
-    
-    if '=' not in instruction:
-        instruction_split.insert(0,'null')
-
-    op_code = '111'
-    if 'M' in instruction_split[1]:
-        a='1'
-        instruction_split[1] = instruction_split[1].replace('M', 'A')
-    else:
-        a='0'
+    try:
+        return format(encode_C(instruction), '016b')
+    except KeyError:
+        logging.exception('KeyError in parse_C function')
 
-    comp_binary = comp(instruction_split[1])
-    dest_binary = dest(instruction_split[0])
-    jump_binary = jump(instruction_split[2])
-    
+def encode_C(instruction):
+    """
+    String -> Int
+    Returns C-instruction as a 16-bit word from the precomputed table of canonical and commuted spellings
+    >>> encode_C('M=D') == 0b1110001100001000
+    True
+    >>> encode_C('AD=M;JMP') == 0b1111110000110111
+    True
+    >>> encode_C('D;JGT') == 0b1110001100000001
+    True
+    >>> encode_C(' AM = M+1 ; JNE ') == encode_C('AM=M+1;JNE')
+    True
+    >>> encode_C('M=M+D') == encode_C('M=D+M')
+    True
+    >>> encode_C('ADHD=M;JEQ')
+    Traceback (most recent call last):
+    ...
+    KeyError: 'ADHD=M;JEQ'
+    """
     try:
-        return op_code + a + comp_binary + dest_binary + jump_binary
-    except Exception as e:
-        logging.exception(e)
+        return C_INSTRUCTIONS[instruction]
+    except KeyError:
+        return encode_C_unusual(instruction)
+
+@lru_cache(maxsize=1024)
+def encode_C_unusual(instruction):
+    """
+    String -> Int
+    Looks up a C-instruction that needed whitespace normalization; bounded cache for spellings
+    that are not in the precomputed table
+    """
+    return C_INSTRUCTIONS[''.join(instruction.split())]
 
 def dest(dest_instruction):
     """
@@ -219,18 +510,8 @@ def dest(dest_instruction):
     >>> dest('ADDING')
     >>> dest('AM.')
     """
-    dest_table = {
-        'null':'000',
-        'M':'001',
-        'D':'010',
-        'MD':'011',
-        'A':'100',
-        'AM':'101',
-        'AD':'110',
-        'AMD':'111'
-    }
     try:
-        return dest_table[dest_instruction]
+        return DEST_TABLE[dest_instruction]
     except KeyError:
         logging.exception('KeyError in dest function')
 
@@ -246,28 +527,8 @@ def comp(comp_instruction):
     '000000'
     >>> comp('D&A.')
     """
-    comp_table = {
-        '0':'101010',
-        '1':'111111',
-        '-1':'111010',
-        'D':'001100',
-        'A':'110000',
-        '!D':'001101',
-        '!A':'110001',
-        '-D':'001111',
-        '-A':'110011',
-        'D+1':'011111',
-        'A+1':'110111',
-        'D-1':'001110',
-        'A-1':'110010',
-        'D+A':'000010',
-        'D-A':'010011',
-        'A-D':'000111',
-        'D&A':'000000',
-        'D|A':'010101'
-    }
     try:
-        return comp_table[comp_instruction]
+        return COMP_TABLE[comp_instruction]
     except KeyError:
         logging.exception('KeyError in comp function')
 
@@ -283,31 +544,159 @@ def jump(jump_instruction):
     '111'
     >>> jump('JUMP')
     """
-    jump_table = {
-        'null':'000',
-        'JGT':'001',
-        'JEQ':'010',
-        'JGE':'011',
-        'JLT':'100',
-        'JNE':'101',
-        'JLE':'110',
-        'JMP':'111'
-    }
     try:
-        return jump_table[jump_instruction]
+        return JUMP_TABLE[jump_instruction]
     except KeyError:
         logging.exception('KeyError in jump function')
 
-def file_write(out_string):
+def scan_labels(in_text, table, allocate_variables=False):
     """
-    String in Memory -> String in File
-    Writes string to file
+    Iterable of Strings, SymbolTable -> Int
+    First streaming pass: records label addresses in table without encoding anything, and with
+    allocate_variables also allocates every variable in first-use order. Returns the number of instructions
+    >>> table = SymbolTable()
+    >>> scan_labels(["(START)", "@END", "0;JMP // go", "(END)", "", "@END"], table)
+    3
+    >>> table.user_symbols()
+    [('START', 0), ('END', 2)]
+    >>> table = SymbolTable()
+    >>> scan_labels(["@sum", "@LOOP", "(LOOP)", "@i", "@R1", "@sum"], table, allocate_variables=True)
+    5
+    >>> table.user_symbols()
+    [('LOOP', 2), ('sum', 16), ('i', 17)]
     """
-    filename = os.path.splitext(sys.argv[1])[0]
-    ext = '.hack'
-    with open(filename + ext, 'w') as writer:
-        writer.write(out_string)
-    
+    pc = 0
+    symbols = {}
+    for line in in_text:
+        if '//' in line:
+            line = line[:line.index('//')]
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == '(':
+            table.add_label(line.strip('()'), pc)
+        else:
+            if allocate_variables and line[0] == '@' and not line[1:].isdigit():
+                symbols[line[1:]] = None
+            pc += 1
+    #labels are all known now, so anything else is a variable in order of first use
+    for symbol in symbols:
+        table.lookup(symbol)
+    return pc
+
+def assemble_stream(in_text, writer, table, binary=False, stats=NULL_STATS):
+    """
+    Iterable of Strings, File, SymbolTable -> Int
+    Second streaming pass: encodes STREAM_CHUNK_LINES lines at a time against a table that already
+    holds every label, writing each chunk before reading the next. Returns the number of words written
+    >>> from io import StringIO
+    >>> program = ["(LOOP)", "@i", "M=M+1", "@LOOP", "0;JMP"]
+    >>> table = SymbolTable()
+    >>> scan_labels(program, table)
+    4
+    >>> writer = StringIO()
+    >>> assemble_stream(program, writer, table)
+    4
+    >>> writer.getvalue().split() == [format(word, '016b') for word in assemble(program)]
+    True
+    """
+    in_text = iter(in_text)
+    line_no = 1
+    count = 0
+    while True:
+        chunk = list(islice(in_text, STREAM_CHUNK_LINES))
+        if not chunk:
+            return count
+        words, labels, refs = lex(chunk, line_no)
+        resolve(words, {}, refs, table)
+        write_words(words, writer, binary, count)
+        if stats.enabled:
+            stats.count('lines', len(chunk))
+            count_kinds(stats, words, labels, refs)
+        line_no += len(chunk)
+        count += len(words)
+
+def stream_file(inf, table, binary=False, stats=NULL_STATS):
+    """
+    File -> File
+    Assembles inf with two streaming passes over the file; memory is bounded by the chunk size
+    and the symbol table, not by the size of the program
+    """
+    with stats.phase('first_pass'), open(inf, 'r') as reader:
+        scan_labels(reader, table)
+    #reading, encoding and writing are interleaved chunk by chunk
+    with stats.phase('encode'), open(inf, 'r') as reader, open(output_path(inf, binary), 'wb' if binary else 'w') as writer:
+        return assemble_stream(reader, writer, table, binary, stats)
+
+def assemble_parallel(in_text, table=None, processes=None, stats=NULL_STATS):
+    """
+    List of Strings, SymbolTable -> Array of words
+    Lexes PARALLEL_CHUNK_LINES lines at a time across a process pool, each chunk encoded from address 0,
+    then places the chunks one after another and resolves every reference in one serial fix-up, as
+    Encoder does. Every line is lexed once, in a worker, and the chunks come back in order, so the words
+    and the symbol table are identical to the serial assemble().
+    Only the lexing runs in parallel: the fix-up, starting the pool and sending the lines and results
+    between processes are extra serial work, so it pays off only for large programs on several cores.
+    On one core, a 408,000-line program took 1.0s against 0.75s serially (lexing is about half of the
+    serial time). Programs under PARALLEL_MIN_LINES lines, which includes anything that fits the 32K ROM,
+    are assembled serially
+    """
+    if len(in_text) < PARALLEL_MIN_LINES:
+        return assemble(in_text, table, stats)
+    #one string per chunk: far cheaper to send to a worker than a list of its lines
+    chunks = [(''.join(in_text[i:i + PARALLEL_CHUNK_LINES]), i + 1) for i in range(0, len(in_text), PARALLEL_CHUNK_LINES)]
+    encoder = Encoder()
+    with stats.phase('first_pass'), Pool(processes) as pool:
+        for lexed in pool.imap(lex_chunk, chunks):
+            encoder.extend(*lexed)
+    with stats.phase('resolve'):
+        encoder.resolve(table)
+    if stats.enabled:
+        count_kinds(stats, encoder.words, encoder.labels, encoder.refs)
+    return encoder.words
+
+def lex_chunk(chunk):
+    """
+    (String, Int) -> Array of words, Dict, List of (Int, String)
+    Lexes one chunk in a worker; addresses are relative to the start of the chunk
+    """
+    text, first_line_no = chunk
+    return lex(text.splitlines(), first_line_no)
+
+def output_path(inf, binary=False):
+    """
+    String -> String
+    >>> output_path('prog/Max.asm'), output_path('prog/Max.asm', binary=True)
+    ('prog/Max.hack', 'prog/Max.bin')
+    """
+    return os.path.splitext(inf)[0] + ('.bin' if binary else '.hack')
+
+def write_words(words, writer, binary=False, written=0):
+    """
+    Array of 16-bit words, File -> None
+    Appends words to an open writer as raw big-endian words, or as lines of binary text;
+    written is the number of words already in the file, so text lines stay newline-separated
+    """
+    if not words:
+        return
+    if binary:
+        if sys.byteorder == 'little':
+            words = array('H', words)
+            words.byteswap()
+        writer.write(words.tobytes())
+    else:
+        if written:
+            writer.write('\n')
+        writer.write('\n'.join(hack_lines(words)))
+
+def file_write(words, inf, binary=False):
+    """
+    Array of 16-bit words -> File
+    Writes words next to inf as a textual .hack file, or as a raw big-endian .bin file
+    """
+    with open(output_path(inf, binary), 'wb' if binary else 'w') as writer:
+        write_words(words, writer, binary)
+
 if __name__ == '__main__':
     main()
     #import doctest
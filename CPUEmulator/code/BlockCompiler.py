@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+ROM -> Python functions
+Execution engine for CPUEmulator that compiles each basic block of the ROM into one Python function the first
+time it is entered, keeping A and D in locals and folding every A-instruction into the code that uses it
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+from CPUEmulator import CPU, MASK, alu
+
+BLOCK_LIMIT = 256 #most instructions compiled into one function
+
+#Python for each documented computation by its c-bits, y being A or M (see CPUEmulator.COMPUTE)
+COMPUTE_SOURCE = {
+    0b101010: '0',
+    0b111111: '1',
+    0b111010: str(MASK),
+    0b001100: 'd',
+    0b110000: '{y}',
+    0b001101: 'd ^ 65535',
+    0b110001: '{y} ^ 65535',
+    0b001111: '-d & 65535',
+    0b110011: '-{y} & 65535',
+    0b011111: '(d + 1) & 65535',
+    0b110111: '({y} + 1) & 65535',
+    0b001110: '(d - 1) & 65535',
+    0b110010: '({y} - 1) & 65535',
+    0b000010: '(d + {y}) & 65535',
+    0b010011: '(d - {y}) & 65535',
+    0b000111: '({y} - d) & 65535',
+    0b000000: 'd & {y}',
+    0b010101: 'd | {y}'
+}
+
+#Python for each jump field, testing the unsigned result x; JMP needs no test
+JUMP_SOURCE = {1: '0 < x < 32768', 2: 'x == 0', 3: 'x < 32768', 4: 'x >= 32768', 5: 'x', 6: 'x == 0 or x >= 32768'}
+
+def block_source(rom, start, end):
+    """
+    Array of words, Int, Int -> String
+    A function of (ram, a, d) running rom[start:end] and returning the next (pc, a, d). Only the last
+    instruction may jump. While A holds a constant it is used as a literal and never stored
+    >>> from assembler import assemble
+    >>> print(block_source(assemble(['@16', 'M=M+1', 'D=M', '@3', 'D;JGT']), 0, 5))
+    def block(ram, a, d):
+        ram[16] = (ram[16] + 1) & 65535
+        d = ram[16]
+        if 0 < d < 32768:
+            return 3, 3, d
+        return 5, 3, d
+    """
+    lines = ['def block(ram, a, d):']
+    known = None #the constant in A, if it holds one
+    for pc in range(start, end):
+        word = rom[pc]
+        if not word & 0x8000:
+            known = word
+            continue
+        register = 'a' if known is None else str(known)
+        bits, dest, jump = (word >> 6) & 0x3F, (word >> 3) & 7, word & 7
+        y = f'ram[{register}]' if word & 0x1000 else register
+        source = COMPUTE_SOURCE[bits].format(y=y) if bits in COMPUTE_SOURCE else f'alu{bits}(d, {y})'
+        targets = ([f'ram[{register}]'] if dest & 1 else []) + (['d'] if dest & 2 else []) + (['a'] if dest & 4 else [])
+        if jump:
+            if dest & 4 and known is None:
+                lines.append('    j = a') #jumps to A as it was before this instruction
+                register = 'j'
+            if jump == 7:
+                test = None
+            elif targets in (['d'], ['a']):
+                test = JUMP_SOURCE[jump].replace('x', targets[0])
+            elif not targets and source.isidentifier():
+                test = JUMP_SOURCE[jump].replace('x', source)
+            else:
+                targets.insert(0, 'x')
+                test = JUMP_SOURCE[jump]
+        if targets:
+            lines.append('    ' + ' = '.join(targets) + ' = ' + source)
+        if dest & 4:
+            known = None
+        result = 'a' if known is None else str(known)
+        if jump == 7:
+            lines.append(f'    return {register}, {result}, d')
+            return '\n'.join(lines)
+        if jump:
+            lines.append(f'    if {test}:')
+            lines.append(f'        return {register}, {result}, d')
+    lines.append(f'    return {end}, {"a" if known is None else known}, d')
+    return '\n'.join(lines)
+
+class CompiledCPU(CPU):
+    """
+    A CPU whose run executes compiled basic blocks, falling back to the interpreter of CPU one instruction
+    at a time where a block cannot go: halt loops, breakpoints, the end of the ROM, and blocks longer than
+    the cycles left to run. Blocks are compiled at whatever address control reaches, so computed jumps
+    (such as VM returns) into the middle of a block just start a new one. Results match CPU exactly
+    >>> from assembler import assemble
+    >>> program = assemble(['@i', 'M=0', '(LOOP)', '@i', 'MD=M+1', '@100', 'D=D-A', '@LOOP', 'D;JLT', '(END)', '@END', '0;JMP'])
+    >>> cpu = CompiledCPU(program)
+    >>> cpu.run(), cpu.ram[16], cpu.halted
+    (603, 100, True)
+    >>> cpu.run(), CPU(program).run()
+    (0, 603)
+    """
+    __slots__ = ('blocks', 'namespace')
+
+    def __init__(self, rom):
+        super().__init__(rom)
+        self.blocks = {} #start address: (function or None, instructions in it)
+        self.namespace = {f'alu{bits}': alu(bits) for bits in range(64)}
+
+    def add_breakpoint(self, address, hook=None):
+        super().add_breakpoint(address, hook)
+        self.blocks.clear()
+
+    def remove_breakpoint(self, address):
+        super().remove_breakpoint(address)
+        self.blocks.clear()
+
+    def compile(self, start):
+        """
+        Int -> (Function or None, Int)
+        The block starting at start: it ends after a jump, before an address the interpreter must run, or
+        after BLOCK_LIMIT instructions. None when start itself is such an address
+        """
+        rom = self.rom
+        end = start
+        while end < len(rom) and end - start < BLOCK_LIMIT and end not in self.halts and end not in self.breakpoints:
+            end += 1
+            if rom[end - 1] & 0x8007 > 0x8000: #a C-instruction with a jump
+                break
+        if end == start:
+            return None, 1
+        compiled = {}
+        exec(block_source(rom, start, end), self.namespace, compiled)
+        return compiled['block'], end - start
+
+    def execute(self, program, cycles=None):
+        blocks, ram = self.blocks, self.ram
+        a, d, pc = self.a, self.d, self.pc
+        executed = compiled = 0
+        try:
+            while cycles is None or executed < cycles:
+                try:
+                    block, length = blocks[pc]
+                except KeyError:
+                    block, length = blocks[pc] = self.compile(pc)
+                if block is None or (cycles is not None and executed + length > cycles):
+                    self.a, self.d, self.pc = a, d, pc
+                    done = CPU.execute(self, program, 1)
+                    a, d, pc = self.a, self.d, self.pc
+                    executed += done
+                    if not done or self.halted: #stopped by a breakpoint or a halt
+                        break
+                    continue
+                pc, a, d = block(ram, a, d)
+                executed += length
+                compiled += length
+        finally:
+            self.a, self.d, self.pc = a, d, pc
+            self.cycles += compiled
+        return executed
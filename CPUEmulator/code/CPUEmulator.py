@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+File of Strings in Binary -> Machine state
+Runs Hack machine code: the ROM is decoded once into tuples, so a cycle is one list lookup and no bit parsing
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+from array import array
+import sys, os, time, argparse
+ASSEMBLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Assembler', 'code')
+sys.path.insert(0, ASSEMBLER_DIR) #for this import only: importing this module leaves sys.path as it was
+try:
+    from SymbolTable import PREDEFINED_SYMBOLS
+finally:
+    sys.path.remove(ASSEMBLER_DIR)
+
+RAM_SIZE = 0x8000 #15-bit addresses
+MASK = 0xFFFF
+SCREEN = PREDEFINED_SYMBOLS['SCREEN']
+KBD = PREDEFINED_SYMBOLS['KBD']
+
+#the 18 documented computations by their c-bits (zx nx zy ny f no), as functions of D and y, where y is A or M
+#by the a-bit; every word is kept unsigned, so a result is masked to 16 bits only when it can leave them
+COMPUTE = {
+    0b101010: lambda d, y: 0,
+    0b111111: lambda d, y: 1,
+    0b111010: lambda d, y: MASK,
+    0b001100: lambda d, y: d,
+    0b110000: lambda d, y: y,
+    0b001101: lambda d, y: d ^ MASK,
+    0b110001: lambda d, y: y ^ MASK,
+    0b001111: lambda d, y: -d & MASK,
+    0b110011: lambda d, y: -y & MASK,
+    0b011111: lambda d, y: (d + 1) & MASK,
+    0b110111: lambda d, y: (y + 1) & MASK,
+    0b001110: lambda d, y: (d - 1) & MASK,
+    0b110010: lambda d, y: (y - 1) & MASK,
+    0b000010: lambda d, y: (d + y) & MASK,
+    0b010011: lambda d, y: (d - y) & MASK,
+    0b000111: lambda d, y: (y - d) & MASK,
+    0b000000: lambda d, y: d & y,
+    0b010101: lambda d, y: d | y
+}
+
+#for each jump field, whether a 16-bit result makes the jump: JUMP_TAKEN[j][out]
+JUMP_TAKEN = [None] + [bytearray(bool((j & 4 and out & 0x8000) or (j & 2 and out == 0) or (j & 1 and 0 < out < 0x8000))
+                                 for out in range(0x10000)) for j in range(1, 8)]
+
+class Breakpoint(Exception):
+    pass
+
+class Halt(Exception):
+    pass
+
+def alu(bits):
+    """
+    Int -> Function
+    The Hack ALU for any 6 c-bits, for the computations missing from COMPUTE
+    >>> [alu(bits)(5, 3) == COMPUTE[bits](5, 3) for bits in (0b000010, 0b010011, 0b001101, 0b111010)]
+    [True, True, True, True]
+    """
+    zx, nx, zy, ny, f, no = ((bits >> shift) & 1 for shift in range(5, -1, -1))
+    def compute(d, y):
+        x = (0 if zx else d) ^ (MASK if nx else 0)
+        y = (0 if zy else y) ^ (MASK if ny else 0)
+        out = (x + y) & MASK if f else x & y
+        return out ^ MASK if no else out
+    return compute
+
+def decode(word):
+    """
+    Int -> (Function or None, Int, Int, bytearray or None)
+    An A-instruction is (None, value, 0, None); a C-instruction is (computation, a-bit, dest, jump table)
+    >>> decode(21)
+    (None, 21, 0, None)
+    >>> compute, reads_m, dest, jump = decode(0b1111110111011000) #MD=M+1
+    >>> compute(0, 41), reads_m, dest, jump
+    (42, 1, 3, None)
+    """
+    if not word & 0x8000:
+        return (None, word, 0, None)
+    bits = (word >> 6) & 0x3F
+    return (COMPUTE.get(bits) or alu(bits), (word >> 12) & 1, (word >> 3) & 7, JUMP_TAKEN[word & 7])
+
+def halt_loop(address, compute):
+    """
+    Int, Function -> Function
+    Stands in for the jump at address, the second half of a @address-1 / 0;JMP loop that a program ends in
+    """
+    def halt(d, y):
+        if y == address - 1: #y is A: a halt loop reads no memory
+            raise Halt
+        return compute(d, y)
+    return halt
+
+def stop(d, y):
+    raise Breakpoint
+
+def end(d, y):
+    raise Halt
+
+def signed(word):
+    """
+    Int -> Int
+    >>> signed(65535), signed(32767)
+    (-1, 32767)
+    """
+    return word - 0x10000 if word & 0x8000 else word
+
+def load_rom(path):
+    """
+    File -> Array of words
+    Reads a textual .hack file, a .bin of big-endian words, or assembles an .asm
+    """
+    if path.endswith('.bin'):
+        words = array('H')
+        with open(path, 'rb') as reader:
+            words.frombytes(reader.read())
+        if sys.byteorder == 'little':
+            words.byteswap()
+        return words
+    with open(path, 'r') as reader:
+        lines = reader.readlines()
+    if path.endswith('.asm'):
+        from assembler import assemble
+        return assemble(lines)
+    return array('H', (int(line, 2) for line in lines if line.strip()))
+
+class CPU(object):
+    """
+    The Hack computer: 32K words of RAM, A, D and PC, and a ROM decoded once when loaded
+    >>> from assembler import assemble
+    >>> cpu = CPU(assemble(['@2', 'D=A', '@3', 'D=D+A', '@0', 'M=D', '(END)', '@END', '0;JMP']))
+    >>> cpu.run(), cpu.halted, cpu.ram[0]
+    (7, True, 5)
+    >>> cpu.reset()
+    >>> cpu.add_breakpoint(4, lambda cpu: cpu.d == 5)
+    >>> cpu.run(), cpu.pc, cpu.d
+    (4, 4, 5)
+    """
+    __slots__ = ('rom', 'program', 'halts', 'ram', 'a', 'd', 'pc', 'cycles', 'halted', 'breakpoints')
+
+    def __init__(self, rom):
+        self.rom = array('H', rom)
+        self.program = [decode(word) for word in self.rom]
+        self.halts = set() #addresses of the jumps of halt loops
+        for address in range(1, len(self.rom)):
+            compute, reads_m, dest, jump = self.program[address]
+            if self.rom[address - 1] == address - 1 and jump is JUMP_TAKEN[7] and not dest and not reads_m:
+                self.program[address] = (halt_loop(address, compute), reads_m, dest, jump)
+                self.halts.add(address)
+        self.program.append((end, 0, 0, None)) #running off the end of the ROM
+        self.breakpoints = {}
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.reset()
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load_rom(path))
+
+    def reset(self):
+        """
+        Clears the registers and the count of cycles, as the reset button does; RAM keeps its contents
+        """
+        self.a = self.d = self.pc = self.cycles = 0
+        self.halted = False
+
+    def add_breakpoint(self, address, hook=None):
+        """
+        Int, Function -> None
+        run stops before executing address, unless hook(cpu) is given and returns a false value
+        """
+        self.breakpoints[address] = hook
+
+    def remove_breakpoint(self, address):
+        self.breakpoints.pop(address, None)
+
+    def step(self):
+        """
+        None -> Int
+        Executes one instruction, ignoring breakpoints
+        """
+        return self.execute(self.program, 1)
+
+    def run(self, cycles=None):
+        """
+        Int -> Int
+        Runs until the program halts, a breakpoint stops it or cycles instructions have run (forever with None).
+        A breakpoint at the address it starts from does not stop it, so run continues from a breakpoint.
+        Returns the number of instructions executed
+        """
+        program = self.program
+        if self.breakpoints:
+            program = program[:]
+            for address in self.breakpoints:
+                if address < len(program):
+                    program[address] = (stop, 0, 0, None)
+        executed = 0
+        if self.pc in self.breakpoints and not self.halted and cycles != 0:
+            executed = self.step()
+        while not self.halted and (cycles is None or executed < cycles):
+            remaining = None if cycles is None else cycles - executed
+            done = self.execute(program, remaining)
+            executed += done
+            if self.halted or done == remaining:
+                break
+            hook = self.breakpoints[self.pc]
+            if hook is None or hook(self):
+                break
+            executed += self.step() #the hook let it go on: run the instruction under the breakpoint
+        return executed
+
+    def execute(self, program, cycles=None):
+        """
+        List of decoded instructions, Int -> Int
+        The fetch-execute loop. Breakpoints and halt loops end it by raising from their computation,
+        which costs nothing on any other cycle
+        """
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+        n = -1 if cycles is None else cycles
+        try:
+            while n:
+                n -= 1
+                compute, x, dest, jump = program[pc]
+                if compute is None:
+                    a = x
+                    pc += 1
+                    continue
+                out = compute(d, ram[a] if x else a)
+                if dest:
+                    if dest & 1:
+                        ram[a] = out
+                    if dest & 2:
+                        d = out
+                    if dest & 4:
+                        pc = a if jump is not None and jump[out] else pc + 1
+                        a = out
+                        continue
+                if jump is not None and jump[out]:
+                    pc = a
+                else:
+                    pc += 1
+        except Breakpoint:
+            n += 1
+        except Halt:
+            n += 1
+            self.halted = True
+        except IndexError:
+            if pc < len(program): #an address past the RAM, not a jump past the ROM
+                raise
+            self.halted = True
+        finally:
+            self.a, self.d, self.pc = a, d, pc
+        executed = (-1 - n) if cycles is None else cycles - n
+        self.cycles += executed
+        return executed
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs Hack machine code.")
+    parser.add_argument('infile', help="<program.hack>, a .bin of big-endian words, or an .asm to assemble first")
+    parser.add_argument('--cycles', type=int, metavar='N', help="stop after N instructions (default: run until it halts)")
+    parser.add_argument('--ram', action='append', default=[], metavar='FIRST[-LAST]',
+                        help="print these RAM words when it stops; may be given more than once")
+    parser.add_argument('--set', action='append', default=[], metavar='ADDRESS=VALUE',
+                        help="write a RAM word before running, e.g. --set 0=256; may be given more than once")
+    parser.add_argument('--compile', action='store_true',
+                        help="run compiled basic blocks instead of interpreting (faster on long runs, see BlockCompiler)")
+    parser.add_argument('--break', dest='breakpoints', type=int, action='append', default=[], metavar='ADDRESS',
+                        help="stop before executing this ROM address")
+    parser.add_argument('--map', metavar='FILE',
+                        help="a source map (.map) written by the assembler or the VM translator, to say where it stopped")
+    args = parser.parse_args()
+
+    if args.compile:
+        from BlockCompiler import CompiledCPU
+        cpu = CompiledCPU.from_file(args.infile)
+    else:
+        cpu = CPU.from_file(args.infile)
+    for assignment in args.set:
+        address, value = assignment.split('=')
+        cpu.ram[int(address)] = int(value) & MASK
+    for address in args.breakpoints:
+        cpu.add_breakpoint(address)
+    start = time.perf_counter()
+    cycles = cpu.run(args.cycles)
+    seconds = time.perf_counter() - start
+    state = 'halted' if cpu.halted else f'stopped at {cpu.pc}'
+    print(f"{state} after {cycles} instructions in {seconds:.3f}s ({cycles / max(seconds, 1e-9):,.0f} instructions/s)")
+    if args.map:
+        from SourceMap import SourceMap
+        print(f"pc {cpu.pc}: {SourceMap.load(args.map).describe(cpu.pc)}")
+    for span in args.ram:
+        first, _, last = span.partition('-')
+        for address in range(int(first), int(last or first) + 1):
+            print(f"RAM[{address}] = {signed(cpu.ram[address])}")
+
+if __name__ == '__main__':
+    main()
+    #import doctest
+    #print(doctest.testmod(verbose=False))
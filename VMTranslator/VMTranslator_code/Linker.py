@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+Files of VM code -> Relocatable objects -> File of Strings in Binary
+Separate compilation: each .vm file compiles on its own to a relocatable .vmo object (encoded instructions,
+the labels it defines and the symbols it references), and the link step joins the objects behind the startup
+code, resolving labels, statics and Sys.init into one .hack. Only the .vm files that changed are compiled again
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+import sys, os, json, logging, argparse
+from multiprocessing import Pool
+from VMTranslator import BOOTSTRAP, __version__, make_writer, namespace, translateSource
+#the assembler modules below are already loaded by the VMTranslator import, which finds them
+from BuildCache import file_digest
+from Stats import Stats, NULL_STATS
+from assembler import Encoder, lex, file_write, __version__ as assembler_version
+
+OBJECT_FORMAT = 1
+#options that change the code of a single file; whole-program ones (inline, prune) need every file at once
+OBJECT_OPTIONS = ('top_in_d', 'shared_routines', 'optimize')
+
+def main():
+    parser = argparse.ArgumentParser(description="Compiles Hack VM files to relocatable objects and links them into machine code.")
+    parser.add_argument('infile', help="<inputfile.vm>, or a directory of .vm files")
+    parser.add_argument('--binary', action='store_true',
+                        help="write raw big-endian 16-bit words to a .bin file instead of a textual .hack file")
+    parser.add_argument('--sym', action='store_true', help="also write the final symbol map to a .sym file")
+    parser.add_argument('--jobs', type=int, metavar='N',
+                        help="compile up to N changed .vm files at once in a worker pool")
+    parser.add_argument('--stats', action='store_true',
+                        help="print per-phase timings and counters as a line of JSON")
+    parser.add_argument('--top-in-d', action='store_true',
+                        help="keep the top of the stack in D between commands (fewer instructions executed)")
+    parser.add_argument('--shared-routines', action='store_true',
+                        help="emit call, return and eq/gt/lt once and jump to them (smaller ROM, a few more cycles each)")
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help="fold constants, drop identities and fuse push/pop pairs before generating code")
+    parser.add_argument('--log', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'VMTranslator.log'),
+                        help="log file (default: logs/VMTranslator.log next to this script)")
+    args = parser.parse_args()
+    os.makedirs(os.path.dirname(os.path.abspath(args.log)), exist_ok=True)
+    logging.basicConfig(filename=args.log, level=logging.DEBUG)
+
+    stats = Stats(args.infile) if args.stats else NULL_STATS
+    options = dict(top_in_d=args.top_in_d, shared_routines=args.shared_routines, optimize=args.optimize)
+    linkPath(args.infile, stats, options, binary=args.binary, sym=args.sym, jobs=args.jobs)
+    if stats.enabled:
+        stats.dump(sys.stdout)
+
+def linkPath(inf, stats=NULL_STATS, options=None, binary=False, sym=False, jobs=None):
+    """
+    Compiles the changed .vm files of a file or directory and links every object into one program
+    01/FunctionDirectory/Function.vm -> 01/FunctionDirectory/Function.vmo -> 01/FunctionDirectory/Function.hack
+    01/FunctionDirectory -> 01/FunctionDirectory/*.vmo -> 01/FunctionDirectory/FunctionDirectory.hack
+    Returns the path of the program, or None if inf is neither
+    """
+    options = object_options(options)
+    inf = os.path.normpath(inf)
+    if inf.endswith('.vm'):
+        program, sources = inf, [inf]
+    elif os.path.isdir(inf):
+        program = os.path.join(inf, os.path.basename(inf))
+        sources = sorted(os.path.join(inf, file) for file in os.listdir(inf) if file.endswith('.vm'))
+    else:
+        logging.error(f"Error opening file {inf}.")
+        return None
+    with stats.phase('compile'):
+        objects = compile_objects(sources, options, stats, jobs)
+    with stats.phase('link'):
+        words, table = link(objects, options)
+    with stats.phase('write'):
+        file_write(words, program, binary=binary)
+        if sym:
+            table.dump(os.path.splitext(program)[0] + '.sym')
+    stats.count('words', len(words))
+    return os.path.splitext(program)[0] + ('.bin' if binary else '.hack')
+
+def object_options(options):
+    """
+    Dict -> Dict
+    The options an object is compiled with, all present so stored and requested options compare equal
+    """
+    options = options or {}
+    return {option: bool(options.get(option)) for option in OBJECT_OPTIONS}
+
+def object_path(inf):
+    """
+    String -> String
+    >>> object_path('prog/Main.vm')
+    'prog/Main.vmo'
+    """
+    return os.path.splitext(inf)[0] + '.vmo'
+
+def compile_objects(sources, options, stats=NULL_STATS, jobs=None):
+    """
+    List of Strings, Dict -> List of Dicts
+    The object of every source, in order: an up-to-date .vmo is loaded, every other source is compiled
+    """
+    objects = [load_object(object_path(source)) for source in sources]
+    stale = [i for i, (source, obj) in enumerate(zip(sources, objects)) if not is_current(obj, source, options)]
+    if jobs and len(stale) > 1:
+        with Pool(jobs) as pool:
+            compiled = pool.starmap(compile_object, [(sources[i], options) for i in stale])
+    else:
+        compiled = [compile_object(sources[i], options) for i in stale]
+    for i, obj in zip(stale, compiled):
+        objects[i] = obj
+    stats.count('objects_compiled', len(stale))
+    stats.count('objects_reused', len(sources) - len(stale))
+    return objects
+
+def is_current(obj, source, options):
+    """
+    Dict or None, String, Dict -> Boolean
+    True when obj was compiled from the present contents of source, by this translator and assembler, with options
+    """
+    return obj is not None and obj.get('format') == OBJECT_FORMAT and obj.get('translator') == __version__ \
+        and obj.get('assembler') == assembler_version and obj.get('options') == options \
+        and obj.get('digest') == file_digest(source)
+
+def compile_object(inf, options):
+    """
+    String, Dict -> Dict
+    Translates one .vm file, encodes it from address 0 and writes it to its .vmo; every address in the
+    code is still symbolic, so the link step can place it anywhere
+    """
+    obj = make_object(namespace(inf), translateSource(inf, options), options)
+    obj['digest'] = file_digest(inf)
+    with open(object_path(inf), 'w') as writer:
+        json.dump(obj, writer)
+    return obj
+
+def make_object(name, asm, options):
+    """
+    String, String, Dict -> Dict
+    >>> obj = make_object('Main', '(Main.f)\\n@Main.0\\nD=M\\n@Main.f\\n0;JMP\\n', {})
+    >>> obj['words'], obj['labels'], obj['refs']
+    ([0, 64528, 0, 60039], {'Main.f': 0}, [[0, 'Main.0'], [2, 'Main.f']])
+    """
+    words, labels, refs = lex(asm.splitlines())
+    return {'format': OBJECT_FORMAT, 'translator': __version__, 'assembler': assembler_version, 'name': name,
+            'options': object_options(options), 'digest': None,
+            'words': words.tolist(), 'labels': labels, 'refs': [list(ref) for ref in refs]}
+
+def load_object(path):
+    """
+    String -> Dict or None
+    None when there is no object yet or it cannot be read
+    """
+    try:
+        with open(path, 'r') as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return None
+
+def link(objects, options=None, table=None):
+    """
+    List of Dicts, Dict -> Array of words, SymbolTable
+    Places the startup code at address 0 and every object after the one before it, relocates their labels
+    and references, then resolves the references as the assembler would resolve the joined .asm: labels
+    anywhere in the program, and statics allocated from 16 in first-use order
+    >>> words, table = link([make_object('Sys', '(Sys.init)\\n@Sys.0\\nM=1\\n@Sys.init\\n0;JMP\\n', {})])
+    >>> table.get_entry('Sys.init') == len(words) - 4, table.get_entry('Sys.0')
+    (True, 16)
+    """
+    options = object_options(options)
+    encoder = Encoder()
+    for obj in [make_object(BOOTSTRAP, make_writer(BOOTSTRAP, options).asm_init(), options)] + objects:
+        if obj['options'] != options:
+            logging.warning(f"{obj['name']} was compiled with {obj['options']}, linking with {options}")
+        for label in obj['labels']:
+            if label in encoder.labels:
+                logging.error(f"{label} is defined in more than one object; using the one in {obj['name']}")
+        encoder.extend(obj['words'], obj['labels'], obj['refs'])
+    if 'Sys.init' not in encoder.labels:
+        logging.warning("No object defines Sys.init, which the startup code calls.")
+    return encoder.words, encoder.resolve(table)
+
+if __name__ == '__main__':
+    main()
+    #import doctest
+    #print(doctest.testmod(verbose=False))
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+Files of VM code -> Machine state
+Runs parsed VM commands directly on the memory the translated program would use: SP, LCL, ARG, THIS and THAT
+in RAM[0-4], temp from 5, statics and the variables of CodeWriter's return from 16 in first-use order, the stack
+from 256, and frames laid out as by CodeWriter.asm_call. A reference for the translator, and a fast way to run VM-level tests
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+import os, time, logging, argparse
+from VMTranslator import namespace
+from VMParser import C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION, C_RETURN, C_CALL, parseLines
+from VMOptimizer import UNARY, BINARY
+
+RAM_SIZE = 0x8000
+#RAM[0-4] and the values asm_init starts them at; the bootstrap call to Sys.init then moves SP, LCL and ARG
+SP, LCL, ARG, THIS, THAT = range(5)
+INITIAL_POINTERS = {SP: 256, LCL: 700, ARG: 800, THIS: 900, THAT: 1000}
+SEGMENT_POINTERS = {'LCL': LCL, 'ARG': ARG, 'THIS': THIS, 'THAT': THAT}
+FIXED_SEGMENTS = {'pointer': 3, 'temp': 5}
+STATIC_BASE = 16
+#what run reports for the IndexError of a command; negative addresses are checked for, since a list would wrap them
+STACK_OVERFLOW = 'stack overflow'
+OUTSIDE_RAM = 'address outside RAM'
+
+class Halt(Exception):
+    pass
+
+def halt(pc):
+    raise Halt
+
+class VMInterpreter(object):
+    """
+    Runs a VM program. Every command becomes a function of the program counter returning the next one, with
+    its segment addresses, labels and functions already resolved to integers, so running a command is one call.
+    RAM holds signed words. Return addresses (on the stack and in retAddr) are command numbers rather than
+    ROM addresses; everything else matches the memory of the translated program
+    >>> vm = VMInterpreter([('Sys.vm', ['function Sys.init 0', 'push constant 2', 'call Sys.double 1', 'pop static 0',
+    ...                                  'label END', 'goto END', 'function Sys.double 0', 'push argument 0',
+    ...                                  'push argument 0', 'add', 'return'])])
+    >>> vm.run(), vm.halted, vm.ram[16], vm.ram[0]
+    (10, True, 4, 261)
+    """
+    __slots__ = ('ram', 'program', 'origins', 'pc', 'steps', 'halted', 'variables')
+
+    def __init__(self, sources, init=True):
+        """
+        List of (String, Iterable of Strings) -> None
+        Loads (file name, VM lines) pairs as one program. With init, it starts as the translated program does,
+        by calling Sys.init with the pointers set as asm_init sets them; without, it starts at the first command
+        """
+        self.ram = [0] * RAM_SIZE
+        for pointer, value in INITIAL_POINTERS.items():
+            self.ram[pointer] = value
+        self.variables = {}
+        self.program = []
+        self.origins = [] #(file, line, VM line) of each command in program, for errors
+        self.pc = self.steps = 0
+        self.halted = False
+        files = [(namespace(name), list(parseLines(lines, name))) for name, lines in sources]
+        targets, functions = self.resolve(files, 2 if init else 0)
+        if init:
+            #when Sys.init returns, the call comes back to command 1, which halts the interpreter
+            self.program.extend([self.call('Sys.init', 0, functions), halt])
+            self.origins.extend([('$bootstrap', 0, 'call Sys.init 0')] * 2)
+        for file, commands in files:
+            function = None
+            for command in commands:
+                if command.type == C_FUNCTION:
+                    function = command.arg2
+                elif command.type == C_LABEL:
+                    continue
+                self.program.append(self.build(command, file, function, targets, functions))
+                self.origins.append((file, command.line_no, command.source))
+        self.program.append(halt) #running off the end
+        self.origins.append(('', 0, 'end of program'))
+
+    @classmethod
+    def from_path(cls, inf, init=True):
+        """
+        A .vm file or a directory of them, in the sorted order translatePath uses
+        """
+        inf = os.path.normpath(inf)
+        sources = [inf] if inf.endswith('.vm') else \
+            sorted(os.path.join(inf, file) for file in os.listdir(inf) if file.endswith('.vm'))
+        files = []
+        for source in sources:
+            with open(source, 'r') as lines:
+                files.append((source, lines.readlines()))
+        return cls(files, init)
+
+    def resolve(self, files, first):
+        """
+        List of (String, List of Commands), Int -> Dict, Dict
+        The command number of every label (scoped as CodeWriter.label scopes them) and every function;
+        labels are not commands themselves, so each stands for the command after it
+        """
+        targets, functions = {}, {}
+        pc = first
+        for file, commands in files:
+            function = None
+            for command in commands:
+                if command.type == C_FUNCTION:
+                    function = command.arg2
+                    functions[function] = pc
+                elif command.type == C_LABEL:
+                    targets[(function or file, command.arg2)] = pc
+                    continue
+                pc += 1
+        return targets, functions
+
+    def variable(self, symbol):
+        """
+        String -> Int
+        The address of a variable of the translated program, numbered from 16 in order of first use as the
+        assembler numbers them: statics (file.index) and the endframe and retAddr of every return
+        """
+        if symbol not in self.variables:
+            self.variables[symbol] = STATIC_BASE + len(self.variables)
+        return self.variables[symbol]
+
+    def address(self, command, file):
+        """
+        Command, String -> (Int or None, Int)
+        (pointer, index) for local/argument/this/that, (None, address) for the other segments
+        """
+        if command.arg2 in SEGMENT_POINTERS:
+            return SEGMENT_POINTERS[command.arg2], command.arg3
+        if command.arg2 == 'static':
+            return None, self.variable(file + '.' + str(command.arg3))
+        return None, FIXED_SEGMENTS[command.arg2] + command.arg3
+
+    def build(self, command, file, function, targets, functions):
+        """
+        Command, String, String, Dict, Dict -> Function
+        """
+        ram = self.ram
+        here = len(self.program)
+        if command.type == C_ARITHMETIC:
+            if command.arg1 in UNARY:
+                compute = UNARY[command.arg1]
+                def op(pc):
+                    sp = ram[SP] - 1
+                    if sp < 0:
+                        raise IndexError(OUTSIDE_RAM)
+                    ram[sp] = compute(ram[sp])
+                    return pc + 1
+                return op
+            compute = BINARY[command.arg1]
+            def op(pc):
+                sp = ram[SP] - 1
+                if sp < 1:
+                    raise IndexError(OUTSIDE_RAM)
+                ram[SP] = sp
+                ram[sp - 1] = compute(ram[sp - 1], ram[sp])
+                return pc + 1
+            return op
+        if command.type == C_PUSH and command.arg2 == 'constant':
+            value = command.arg3
+            def op(pc):
+                sp = ram[SP]
+                if sp < 0:
+                    raise IndexError(OUTSIDE_RAM)
+                ram[sp] = value
+                ram[SP] = sp + 1
+                return pc + 1
+            return op
+        if command.type in (C_PUSH, C_POP):
+            pointer, index = self.address(command, file)
+            if command.type == C_PUSH and pointer is None:
+                def op(pc):
+                    sp = ram[SP]
+                    if sp < 0:
+                        raise IndexError(OUTSIDE_RAM)
+                    ram[sp] = ram[index]
+                    ram[SP] = sp + 1
+                    return pc + 1
+            elif command.type == C_PUSH:
+                def op(pc):
+                    sp, address = ram[SP], ram[pointer] + index
+                    if sp < 0 or address < 0:
+                        raise IndexError(OUTSIDE_RAM)
+                    ram[sp] = ram[address]
+                    ram[SP] = sp + 1
+                    return pc + 1
+            elif pointer is None:
+                def op(pc):
+                    sp = ram[SP] - 1
+                    if sp < 0:
+                        raise IndexError(OUTSIDE_RAM)
+                    ram[SP] = sp
+                    ram[index] = ram[sp]
+                    return pc + 1
+            else:
+                def op(pc):
+                    sp, address = ram[SP] - 1, ram[pointer] + index
+                    if sp < 0 or address < 0:
+                        raise IndexError(OUTSIDE_RAM)
+                    ram[SP] = sp
+                    ram[address] = ram[sp]
+                    return pc + 1
+            return op
+        if command.type in (C_GOTO, C_IF):
+            try:
+                target = targets[(function or file, command.arg2)]
+            except KeyError:
+                raise ValueError(f"{file}: no label {command.arg2} for line {command.line_no}: {command.source}")
+            if command.type == C_GOTO:
+                return halt if target == here else lambda pc: target
+            def op(pc):
+                sp = ram[SP] - 1
+                if sp < 0:
+                    raise IndexError(OUTSIDE_RAM)
+                ram[SP] = sp
+                return target if ram[sp] else pc + 1
+            return op
+        if command.type == C_FUNCTION:
+            nVars = command.arg3
+            def op(pc):
+                sp = ram[SP]
+                if sp < 0:
+                    raise IndexError(OUTSIDE_RAM)
+                if sp + nVars > RAM_SIZE: #a slice would grow the RAM instead of failing
+                    raise IndexError(STACK_OVERFLOW)
+                ram[sp:sp + nVars] = [0] * nVars
+                ram[SP] = sp + nVars
+                return pc + 1
+            return op
+        if command.type == C_CALL:
+            return self.call(command.arg2, command.arg3, functions)
+        if command.type == C_RETURN:
+            endframe, retaddr = self.variable('endframe'), self.variable('retAddr')
+            def op(pc):
+                frame, arg, sp = ram[LCL], ram[ARG], ram[SP] - 1
+                if frame < 5 or arg < 0 or sp < 0:
+                    raise IndexError(OUTSIDE_RAM)
+                ram[endframe] = frame - 4 #where the return's walk down the saved frame leaves it
+                ret = ram[retaddr] = ram[frame - 5]
+                ram[arg] = ram[sp]
+                ram[SP] = arg + 1
+                ram[THAT], ram[THIS], ram[ARG], ram[LCL] = ram[frame - 1], ram[frame - 2], ram[frame - 3], ram[frame - 4]
+                return ret
+            return op
+        raise ValueError(f"{file}: cannot run line {command.line_no}: {command.source}")
+
+    def call(self, function, nArgs, functions):
+        """
+        String, Int, Dict -> Function
+        Pushes the return address (the next command) and the caller's LCL, ARG, THIS and THAT, then points ARG
+        at the arguments and LCL at the new frame, as asm_call does
+        """
+        ram = self.ram
+        try:
+            target = functions[function]
+        except KeyError:
+            raise ValueError(f"call to undefined function {function}")
+        def op(pc):
+            sp = ram[SP]
+            if sp < 0:
+                raise IndexError(OUTSIDE_RAM)
+            if sp + 5 > RAM_SIZE:
+                raise IndexError(STACK_OVERFLOW)
+            ram[sp:sp + 5] = [pc + 1, ram[LCL], ram[ARG], ram[THIS], ram[THAT]]
+            ram[SP] = ram[LCL] = sp + 5
+            ram[ARG] = sp - nArgs
+            return target
+        return op
+
+    def run(self, steps=None):
+        """
+        Int -> Int
+        Runs until the program halts (Sys.init returns, a goto jumps to itself, or the last command is done)
+        or steps commands have run. Returns the number of commands run. A command that overflows the stack
+        or addresses outside RAM raises ValueError naming it, and leaves pc at it
+        """
+        program = self.program
+        pc = self.pc
+        n = -1 if steps is None else steps
+        try:
+            while n:
+                n -= 1
+                pc = program[pc](pc)
+        except Halt:
+            n += 1
+            self.halted = True
+        except IndexError as error:
+            if not 0 <= pc < len(program):
+                raise ValueError(f"jump to command {pc}, outside the program") from error
+            file, line_no, source = self.origins[pc]
+            problem = STACK_OVERFLOW if str(error) == STACK_OVERFLOW else OUTSIDE_RAM
+            raise ValueError(f"{file}: {problem} at command {pc}, line {line_no}: {source}") from error
+        finally:
+            self.pc = pc
+        executed = (-1 - n) if steps is None else steps - n
+        self.steps += executed
+        return executed
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs Hack VM code directly, without translating it.")
+    parser.add_argument('infile', help="<inputfile.vm>, or a directory of .vm files")
+    parser.add_argument('--steps', type=int, metavar='N', help="stop after N commands (default: run until it halts)")
+    parser.add_argument('--no-init', action='store_true',
+                        help="start at the first command with SP at 256 instead of calling Sys.init")
+    parser.add_argument('--ram', action='append', default=[], metavar='FIRST[-LAST]',
+                        help="print these RAM words when it stops; may be given more than once")
+    parser.add_argument('--set', action='append', default=[], metavar='ADDRESS=VALUE',
+                        help="write a RAM word before running, e.g. --set 1=300; may be given more than once")
+    parser.add_argument('--log', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'VMTranslator.log'),
+                        help="log file (default: logs/VMTranslator.log next to this script)")
+    args = parser.parse_args()
+    os.makedirs(os.path.dirname(os.path.abspath(args.log)), exist_ok=True)
+    logging.basicConfig(filename=args.log, level=logging.DEBUG)
+
+    vm = VMInterpreter.from_path(args.infile, init=not args.no_init)
+    for assignment in args.set:
+        address, value = assignment.split('=')
+        vm.ram[int(address)] = int(value)
+    start = time.perf_counter()
+    steps = vm.run(args.steps)
+    seconds = time.perf_counter() - start
+    state = 'halted' if vm.halted else f'stopped at command {vm.pc}'
+    print(f"{state} after {steps} commands in {seconds:.3f}s ({steps / max(seconds, 1e-9):,.0f} commands/s)")
+    for span in args.ram:
+        first, _, last = span.partition('-')
+        for address in range(int(first), int(last or first) + 1):
+            print(f"RAM[{address}] = {vm.ram[address]}")
+
+if __name__ == '__main__':
+    main()
+    #import doctest
+    #print(doctest.testmod(verbose=False))
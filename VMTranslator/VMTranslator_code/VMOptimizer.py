@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+Commands -> Commands
+Optimizations run on parsed VM commands before CodeWriter sees them: a peephole pass folding constant
+arithmetic, dropping identities and fusing push/pop pairs into moves, whole-program inlining and tail calls,
+and whole-program dead function elimination
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+from itertools import count
+from VMParser import C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION, C_RETURN, C_CALL, C_MOVE, \
+    C_INLINE_ENTER, C_INLINE_EXIT, C_TAILCALL, Command
+
+WINDOW = 64 #commands held back for later patterns; anything older is passed on unchanged
+INLINE_LIMIT = 16 #default largest function body (in commands) copied into its callers
+CALLS = frozenset((C_CALL, C_TAILCALL))
+
+def wrap(value):
+    """
+    Int -> Int
+    Wraps to a signed 16-bit word, as the Hack ALU does
+    >>> wrap(32767 + 1), wrap(-32768 - 1), wrap(5)
+    (-32768, 32767, 5)
+    """
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+#each folds to what the code from CodeWriter computes; comparisons test the sign of the wrapped x - y like the
+#generated D;JGT etc. do, so gt/lt fold the same way even when x - y overflows
+UNARY = {'neg': lambda y: wrap(-y), 'not': lambda y: ~y}
+BINARY = {'add': lambda x, y: wrap(x + y), 'sub': lambda x, y: wrap(x - y),
+          'and': lambda x, y: x & y, 'or': lambda x, y: x | y,
+          'eq': lambda x, y: -1 if wrap(x - y) == 0 else 0,
+          'gt': lambda x, y: -1 if wrap(x - y) > 0 else 0,
+          'lt': lambda x, y: -1 if wrap(x - y) < 0 else 0}
+#x op constant == x
+IDENTITIES = {('add', 0), ('sub', 0), ('or', 0), ('and', -1)}
+#op op == nothing
+SELF_INVERSE = frozenset(('neg', 'not'))
+
+def optimize(commands):
+    """
+    Iterable of Commands -> Iterable of Commands
+    >>> from VMParser import parseLines
+    >>> list(optimize(parseLines(['push constant 2', 'push constant 3', 'add', 'neg', 'pop local 1'])))
+    [Command(C_MOVE, 'move', ('constant', -5), ('LCL', 1))]
+    >>> list(optimize(parseLines(['push argument 0', 'push constant 0', 'add', 'not', 'not', 'label END'])))
+    [Command(C_PUSH, 'push', 'ARG', 0), Command(C_LABEL, 'label', 'END', None)]
+    """
+    out = []
+    for command in commands:
+        out.append(command)
+        while simplify(out):
+            pass
+        if len(out) >= 2 * WINDOW:
+            yield from out[:WINDOW]
+            del out[:WINDOW]
+    yield from out
+
+def is_constant(command):
+    return command.type == C_PUSH and command.arg2 == 'constant'
+
+def simplify(out):
+    """
+    List of Commands -> Boolean
+    Rewrites the end of out with the first pattern that applies; False when none does
+    """
+    last = out[-1]
+    if last.type == C_ARITHMETIC and len(out) >= 2:
+        op, operand = last.arg1, out[-2]
+        if op in UNARY:
+            if is_constant(operand):
+                out[-2:] = [constant(UNARY[op](operand.arg3), operand)]
+                return True
+            if operand.type == C_ARITHMETIC and operand.arg1 == op and op in SELF_INVERSE:
+                del out[-2:]
+                return True
+        elif is_constant(operand):
+            if len(out) >= 3 and is_constant(out[-3]):
+                out[-3:] = [constant(BINARY[op](out[-3].arg3, operand.arg3), out[-3])]
+                return True
+            if (op, operand.arg3) in IDENTITIES:
+                del out[-2:]
+                return True
+    elif last.type == C_POP and len(out) >= 2 and out[-2].type == C_PUSH and last.arg2 != 'constant':
+        push = out[-2]
+        if (push.arg2, push.arg3) == (last.arg2, last.arg3):
+            del out[-2:]
+        else:
+            out[-2:] = [Command(C_MOVE, 'move', (push.arg2, push.arg3), (last.arg2, last.arg3),
+                                push.source.strip() + ' / ' + last.source.strip(), push.line_no)]
+        return True
+    return False
+
+def constant(value, first):
+    """
+    Int, Command -> Command
+    push constant value, standing in for the commands starting at first
+    """
+    return Command(C_PUSH, 'push', 'constant', value, 'push constant ' + str(value), first.line_no)
+
+def call_graph(programs):
+    """
+    Iterable of Lists of Commands -> Dict of String: Set of Strings
+    Maps each function to the functions it calls; calls outside any function are listed under None
+    """
+    graph = {None: set()}
+    for commands in programs:
+        caller = None
+        for command in commands:
+            if command.type == C_FUNCTION:
+                caller = command.arg2
+                graph.setdefault(caller, set())
+            elif command.type in CALLS:
+                graph[caller].add(command.arg2)
+    return graph
+
+def live_functions(graph, entry='Sys.init'):
+    """
+    Dict of String: Set of Strings, String -> Set of Strings
+    Functions reachable from entry (and from calls outside any function)
+    >>> sorted(live_functions({None: set(), 'Sys.init': {'Main.main'}, 'Main.main': {'Math.multiply', 'Main.main'},
+    ...                        'Math.multiply': set(), 'Math.divide': {'Math.multiply'}}))
+    ['Main.main', 'Math.multiply', 'Sys.init']
+    """
+    live = set()
+    pending = [entry, *graph[None]]
+    while pending:
+        function = pending.pop()
+        if function not in live:
+            live.add(function)
+            pending.extend(graph.get(function, ()))
+    return live
+
+def prune(commands, live):
+    """
+    Iterable of Commands, Set of Strings -> Iterable of Commands
+    Drops the body of every function not in live
+    """
+    keep = True
+    for command in commands:
+        if command.type == C_FUNCTION:
+            keep = command.arg2 in live
+        if keep:
+            yield command
+
+def split_functions(commands):
+    """
+    List of Commands -> Iterable of (Command or None, List of Commands)
+    Each function command with the commands up to the next one; commands before the first function come with None
+    """
+    start, function = 0, None
+    for i, command in enumerate(commands):
+        if command.type == C_FUNCTION:
+            if i > start or function is not None:
+                yield function, commands[start + (function is not None):i]
+            start, function = i, command
+    yield function, commands[start + (function is not None):]
+
+def segments(command):
+    """
+    Command -> Tuple of Strings
+    The segments a push, pop or move reads or writes, the written one last
+    """
+    if command.type in (C_PUSH, C_POP):
+        return (command.arg2,)
+    elif command.type == C_MOVE:
+        return (command.arg2[0], command.arg3[0])
+    return ()
+
+def optimize_calls(programs, limit=INLINE_LIMIT):
+    """
+    List of Lists of Commands, Int -> List of Lists of Commands
+    Copies leaf functions (no calls) of at most limit commands into their call sites, and turns every other
+    call followed directly by return into a tail call reusing the caller's frame. A function using statics
+    is only copied into callers in its own file, where its statics have the same names
+    """
+    inlinable, known_args = {}, {}
+    for index, commands in enumerate(programs):
+        for function, body in split_functions(commands):
+            if function is not None:
+                known_args[function.arg2] = 1 + max((i for _, i in arguments(body)), default=-1)
+            if function is not None and len(body) <= limit and not any(command.type in CALLS for command in body):
+                uses_statics = any('static' in segments(command) for command in body)
+                inlinable[function.arg2] = (index if uses_statics else None, function.arg3, body)
+    sites = count()
+    return [list(expand_calls(commands, index, inlinable, known_args, sites)) for index, commands in enumerate(programs)]
+
+def arguments(body):
+    """
+    List of Commands -> Iterable of (String, Int)
+    Every (segment, index) a push, pop or move in body uses in the argument segment
+    """
+    for command in body:
+        if command.type in (C_PUSH, C_POP):
+            pairs = ((command.arg2, command.arg3),)
+        elif command.type == C_MOVE:
+            pairs = (command.arg2, command.arg3)
+        else:
+            continue
+        for pair in pairs:
+            if pair[0] == 'ARG':
+                yield pair
+
+def expand_calls(commands, index, inlinable, known_args, sites):
+    """
+    The TAILCALL arg3 is (nArgs, the number of arguments the caller is known to have)
+    """
+    out, caller = [], None
+    for command in commands:
+        if command.type == C_FUNCTION:
+            caller = command.arg2
+        if command.type == C_RETURN and out and out[-1].type == C_CALL:
+            call = out.pop()
+            out.append(Command(C_TAILCALL, 'call', call.arg2, (call.arg3, known_args.get(caller, 0)),
+                               call.source.strip() + ' / ' + command.source.strip(), call.line_no))
+        elif command.type == C_CALL and command.arg2 in inlinable and inlinable[command.arg2][0] in (None, index):
+            out.extend(inline_call(command, *inlinable[command.arg2][1:], next(sites)))
+        else:
+            out.append(command)
+    return out
+
+def inline_call(call, nVars, body, site):
+    """
+    Command, Int, List of Commands, Int -> Iterable of Commands
+    The body of the function called by call, with its labels renamed for this site. Every command takes the
+    line number of the call, its only line in the caller's file, so errors and source maps point at the call
+    """
+    save_pointers = any(command.type in (C_POP, C_MOVE) and segments(command)[-1] == 'pointer' for command in body)
+    suffix = '$inline.' + str(site)
+    end = call.arg2 + '$return' + suffix
+    yield Command(C_INLINE_ENTER, 'call', call.arg2, (call.arg3, nVars, save_pointers), call.source, call.line_no)
+    jumps_to_end = False
+    for i, command in enumerate(body):
+        if command.type in (C_LABEL, C_GOTO, C_IF):
+            yield Command(command.type, command.arg1, command.arg2 + suffix, None, command.source, call.line_no)
+        elif command.type == C_RETURN:
+            yield Command(C_INLINE_EXIT, 'return', call.arg2, save_pointers, command.source, call.line_no)
+            if i < len(body) - 1:
+                yield Command(C_GOTO, 'goto', end, None, 'goto ' + end, call.line_no)
+                jumps_to_end = True
+        else:
+            yield Command(command.type, command.arg1, command.arg2, command.arg3, command.source, call.line_no)
+    if jumps_to_end:
+        yield Command(C_LABEL, 'label', end, None, 'label ' + end, call.line_no)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: JGSnyder
+@email: jakegsnyder43@gmail.com
+String -> Command
+Parses VM lines into Command records, shared by the translator and the optimizer
+Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
+"""
+import logging
+
+#command types, as returned by Parser.command_type
+C_ARITHMETIC = 'C_ARITHMETIC'
+C_PUSH = 'C_PUSH'
+C_POP = 'C_POP'
+C_LABEL = 'C_LABEL'
+C_GOTO = 'C_GOTO'
+C_IF = 'C_IF'
+C_FUNCTION = 'C_FUNCTION'
+C_RETURN = 'C_RETURN'
+C_CALL = 'C_CALL'
+C_MOVE = 'C_MOVE' #push/pop pair fused by VMOptimizer; arg2 and arg3 are the (segment, index) moved from and to
+#made by VMOptimizer.optimize_calls: an inlined function body runs between INLINE_ENTER (arg3 is
+#(nArgs, nVars, save_pointers)) and INLINE_EXIT (arg3 is save_pointers); TAILCALL is call directly followed by return
+C_INLINE_ENTER = 'C_INLINE_ENTER'
+C_INLINE_EXIT = 'C_INLINE_EXIT'
+C_TAILCALL = 'C_TAILCALL'
+
+COMMAND_TYPES = {'push': C_PUSH, 'pop': C_POP,
+                 'add': C_ARITHMETIC, 'sub': C_ARITHMETIC, 'neg': C_ARITHMETIC, 'eq': C_ARITHMETIC, 'gt': C_ARITHMETIC,
+                 'lt': C_ARITHMETIC, 'and': C_ARITHMETIC, 'or': C_ARITHMETIC, 'not': C_ARITHMETIC,
+                 'label': C_LABEL, 'goto': C_GOTO, 'if-goto': C_IF,
+                 'function': C_FUNCTION, 'return': C_RETURN, 'call': C_CALL}
+#command types whose third token is a number: push/pop index, function nVars, call nArgs
+NUMERIC_ARG3 = frozenset((C_PUSH, C_POP, C_FUNCTION, C_CALL))
+MEMORY_ABBREVIATIONS = {'local': 'LCL', 'argument': 'ARG', 'this': 'THIS', 'that': 'THAT'}
+#segments at fixed RAM addresses and their sizes: temp is RAM[5-12], pointer is THIS and THAT
+FIXED_SEGMENT_SIZES = {'temp': 8, 'pointer': 2}
+
+class Command(object):
+    """
+    One parsed VM command: its type, 'push' or 'add' etc. in arg1, the segment/label/function in arg2
+    and the index/nVars/nArgs in arg3
+    """
+    __slots__ = ('type', 'arg1', 'arg2', 'arg3', 'source', 'line_no')
+
+    def __init__(self, type, arg1, arg2=None, arg3=None, source='', line_no=0):
+        self.type = type
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.arg3 = arg3
+        self.source = source
+        self.line_no = line_no
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and \
+            (self.type, self.arg1, self.arg2, self.arg3) == (other.type, other.arg1, other.arg2, other.arg3)
+
+    def __repr__(self):
+        return f"Command({self.type}, {self.arg1!r}, {self.arg2!r}, {self.arg3!r})"
+
+def parse_command(line, line_no=0):
+    """
+    String -> Command or None
+    Tokenizes one VM line; None for blank and comment-only lines. An index outside temp or pointer is a
+    ValueError, since its address would land on another segment
+    """
+    tokens = (line.partition('//')[0] if '//' in line else line).split()
+    if not tokens:
+        return None
+    type = COMMAND_TYPES[tokens[0]]
+    arg2 = tokens[1] if len(tokens) > 1 else None
+    arg2 = MEMORY_ABBREVIATIONS.get(arg2, arg2)
+    arg3 = int(tokens[2]) if type in NUMERIC_ARG3 else None
+    if arg2 in FIXED_SEGMENT_SIZES and type in (C_PUSH, C_POP) and not 0 <= arg3 < FIXED_SEGMENT_SIZES[arg2]:
+        raise ValueError(f"{arg2} {arg3} is outside the {arg2} segment")
+    return Command(type, tokens[0], arg2, arg3, line.rstrip('\n'), line_no)
+
+class Parser(object):
+    def __init__(self, line):
+        #removes comments and extra space, then tokenizes once
+        self.line = line.partition('//')[0].strip()
+        self.tokens = self.line.split()
+
+    def command_type(self):
+        try:
+            return COMMAND_TYPES[self.tokens[0]]
+        except Exception:
+            logging.exception("Not a valid command type.")
+
+    def arg1(self):
+        """
+        String -> String
+        """
+        return self.tokens[0]
+    
+    def arg2(self):
+        """
+        String -> String
+        Returns 'static' in push static i OR 'LCL' in pop local i
+        """
+        var = self.tokens[1] # 'static' or 'constant'
+        return MEMORY_ABBREVIATIONS.get(var, var)
+    
+    def arg3(self):
+        """
+        String -> Int
+        Returns i in 'push constant i' or 'pop static i'
+        """
+        return int(self.tokens[2])
+
+def parseLines(lines, inf=''):
+    """
+    Iterable of Strings -> Iterable of Commands
+    Tokenizes each line once; blank and comment-only lines produce nothing, bad lines are logged and skipped
+    """
+    for line_no, line in enumerate(lines, 1):
+        try:
+            command = parse_command(line, line_no)
+        except (KeyError, ValueError, IndexError):
+            logging.exception(f"Error on {inf} line {line_no}.")
+        else:
+            if command is not None:
+                yield command
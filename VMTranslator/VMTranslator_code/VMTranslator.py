@@ -8,133 +8,593 @@ File of Strings -> File of Strings
 Converts VM lines of text to asm lines of text
 Code built as part of nand2tetris class on https://www.coursera.org/learn/build-a-computer/
 """
-import sys, os, re, logging
-import AssemblyTable
+import sys, os, logging, argparse
+from itertools import islice
+from multiprocessing import Pool
+ASSEMBLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Assembler', 'code')
+sys.path.insert(0, ASSEMBLER_DIR) #for these imports only: importing this module leaves sys.path as it was
+try:
+    from SymbolTable import SymbolTable
+    from BuildCache import BuildCache, file_digest
+    from Stats import Stats, NULL_STATS
+    from SourceMap import SourceMap
+    from assembler import Encoder, file_write, output_path, __version__ as assembler_version
+finally:
+    sys.path.remove(ASSEMBLER_DIR)
+from VMParser import C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION, C_RETURN, C_CALL, C_MOVE, \
+    C_INLINE_ENTER, C_INLINE_EXIT, C_TAILCALL, Command, Parser, parse_command, parseLines
+import VMOptimizer
+
+__version__ = '1.3'
+WRITE_BATCH = 4096 #commands joined into each write to the .asm file
+BOOTSTRAP = '$bootstrap' #names the startup code's labels; '$' keeps it apart from every .vm file name
 
 def main():
-    assert len(sys.argv) == 2, "Usage: python VMTranslator.py <inputfile.vm>"
-    logging.basicConfig(filename='logs/VMTranslator.log', level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description="Translates Hack VM code into Hack assembly.")
+    parser.add_argument('infile', help="<inputfile.vm>, or a directory of .vm files")
+    parser.add_argument('--hack', action='store_true',
+                        help="assemble in the same process and write .hack directly, with no .asm in between")
+    parser.add_argument('--binary', action='store_true',
+                        help="with --hack, write raw big-endian 16-bit words to a .bin file instead")
+    parser.add_argument('--asm', action='store_true', help="with --hack, also write the .asm")
+    parser.add_argument('--map', action='store_true',
+                        help="also write a source map (.map) from each ROM address to its asm line, VM file and line, and function")
+    parser.add_argument('--no-comments', action='store_true',
+                        help="leave the VM line out of the .asm in front of each command's code (a .map still finds it)")
+    parser.add_argument('--jobs', type=int, metavar='N',
+                        help="translate up to N .vm files at once in a worker pool")
+    parser.add_argument('--stats', action='store_true',
+                        help="print per-phase timings and counters as a line of JSON")
+    parser.add_argument('--top-in-d', action='store_true',
+                        help="keep the top of the stack in D between commands (fewer instructions executed)")
+    parser.add_argument('--shared-routines', action='store_true',
+                        help="emit call, return and eq/gt/lt once and jump to them (smaller ROM, a few more cycles each)")
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help="fold constants, drop identities and fuse push/pop pairs before generating code")
+    parser.add_argument('--inline', action='store_true',
+                        help="copy small leaf functions into their callers and turn call followed by return into a tail call")
+    parser.add_argument('--inline-limit', type=int, default=VMOptimizer.INLINE_LIMIT, metavar='N',
+                        help="with --inline, the largest function body copied, in commands (default %(default)s)")
+    parser.add_argument('--prune', action='store_true',
+                        help="parse the whole program first and leave out functions Sys.init can never reach")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always translate, ignoring and not updating the build cache")
+    parser.add_argument('--cache-dir', help="build cache directory (default: $NAND2TETRIS_CACHE or ~/.cache/nand2tetris)")
+    parser.add_argument('--log', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'VMTranslator.log'),
+                        help="log file (default: logs/VMTranslator.log next to this script)")
+    args = parser.parse_args()
+    if (args.binary or args.asm) and not args.hack:
+        parser.error("--binary and --asm only apply with --hack")
+    os.makedirs(os.path.dirname(os.path.abspath(args.log)), exist_ok=True)
+    logging.basicConfig(filename=args.log, level=logging.DEBUG)
 
-    inf = sys.argv[1] #01/FunctionDirectory/Function.vm
-    filename = os.path.splitext(os.path.basename(inf))[0] + '.asm' #Function.asm
-    code = CodeWriter(filename)
     try:
-        if inf.endswith('.vm'):
-            filepath = os.path.splitext(inf)[0] + '.asm' #/01/FunctionDirectory/Function.asm
-            with open(filepath, 'w') as outf:
-                #write initial setup code
-                outf.write(code.asm_init())
-                translateFile(code, inf, outf)
-
-        elif os.path.isdir(inf): #FunctionDirectory
-            if inf.endswith('/'):
-                inf = inf[0:-1] #../main/ -> ../main
-            filepath = inf + '/' + filename #01/FunctionDirectory/FunctionDirectory.asm
-            with open(filepath, 'w') as outf:
-                #write initial setup code
-                outf.write(code.asm_init())
-                for file in os.listdir(inf):
-                    if file.endswith('.vm'):
-                        translateFile(code, inf + '/' + file, outf)
-                        code.staticsCounter += 1
-        else:
-            logging.exception("Error opening file.", exc_info=True)
+        stats = Stats(args.infile) if args.stats else NULL_STATS
+        options = dict(hack=args.hack, binary=args.binary, asm=args.asm, map=args.map, comments=not args.no_comments,
+                       jobs=args.jobs, top_in_d=args.top_in_d, shared_routines=args.shared_routines, optimize=args.optimize,
+                       inline=args.inline_limit if args.inline else None, prune=args.prune)
+        translatePath(args.infile, None if args.no_cache else BuildCache(args.cache_dir), stats, options)
+        if stats.enabled:
+            stats.dump(sys.stdout)
     #TODO not logging properly
     except PermissionError:
         logging.exception("You do not have the appropriate permissions. Run chmod a+x on the file you are working with and try again.")
     except FileNotFoundError:
         logging.exception("The file was not found. Please try again.")
 
-def translateFile(code, inf, outf):
-    line_no = 0
-    #parse each line, convert, and write to outf
-    for line in open(inf, 'r'):
-        try:
-            p = Parser(line)
-            if p.line == '': #ignore empty lines
-                continue
-            elif p.command_type() == 'C_ARITHMETIC':
-                commandString = code.asm_arithmetic(p.arg1())
-            elif p.command_type() in ('C_PUSH', 'C_POP'):
-                commandString = code.asm_pushpop(p.arg1(), p.arg2(), p.arg3())
-            elif p.command_type() == 'C_LABEL':
-                commandString = code.asm_label(p.arg2())
-            elif p.command_type() == 'C_GOTO':
-                commandString = code.asm_goto(p.arg2())
-            elif p.command_type() == 'C_IF':
-                commandString = code.asm_if(p.arg2())
-            elif p.command_type() == 'C_FUNCTION':
-                commandString = code.asm_function(p.arg2(), p.arg3())
-            elif p.command_type() == 'C_CALL':
-                commandString = code.asm_call(p.arg2(), p.arg3())
-            elif p.command_type() == 'C_RETURN':
-                commandString = code.asm_return()
-            else:
-                commandString = ""
-        except Exception:
-            logging.exception(f"Error on {inf} line {line_no}.")
+def translatePath(inf, cache=None, stats=NULL_STATS, options=None):
+    """
+    Translates a .vm file, or every .vm file in a directory, into one .asm file and returns its path
+    01/FunctionDirectory/Function.vm -> 01/FunctionDirectory/Function.asm
+    01/FunctionDirectory -> 01/FunctionDirectory/FunctionDirectory.asm
+    With the hack option it returns the path of the .hack (or .bin) instead; see translateHack
+    Every file is translated on its own, with statics and labels named after the file and its functions,
+    and the results follow the startup code in sorted file name order, so the output never depends on
+    the order files are listed or finished in
+    With a cache, unchanged sources are not translated again; the .asm is copied from the cache
+    options (all off by default):
+        hack: assemble in the same process, writing .hack and no .asm
+        binary: with hack, write a .bin of raw big-endian words instead of a .hack
+        asm: with hack, write the .asm as well
+        map: write a SourceMap of the program next to the output, as a .map
+        comments: precede each command's assembly with its VM line (on unless set to False)
+        jobs: translate up to this many files at once in a worker pool
+        top_in_d: the generated code keeps the top of the stack in D (see TopOfStackCodeWriter)
+        shared_routines: call, return and eq/gt/lt jump to one shared copy (see CodeWriter.asm_routines)
+        optimize: VMOptimizer rewrites each file's commands before code generation
+        inline: largest function body copied into its callers; call followed by return becomes a tail call
+        prune: functions that cannot be reached from Sys.init are left out
+        With inline or prune, every file is parsed before any code is written (see translateProgram)
+    """
+    options = options or {}
+    inf = os.path.normpath(inf) #../main/ -> ../main
+    if inf.endswith('.vm'):
+        filepath = os.path.splitext(inf)[0] + '.asm' #/01/FunctionDirectory/Function.asm
+        sources = [inf]
+    elif os.path.isdir(inf): #FunctionDirectory
+        filepath = os.path.join(inf, os.path.basename(inf) + '.asm') #01/FunctionDirectory/FunctionDirectory.asm
+        sources = sorted(os.path.join(inf, file) for file in os.listdir(inf) if file.endswith('.vm'))
+    else:
+        logging.error(f"Error opening file {inf}.")
+        return None
+    outputs = [filepath]
+    if options.get('hack'):
+        outputs = [output_path(filepath, options.get('binary'))] + ([filepath] if options.get('asm') else [])
+    if options.get('map'):
+        outputs.append(map_path(filepath))
+    if cache is not None:
+        #file names are part of the key: they name the statics in the output. jobs does not change the output,
+        #and with hack the assembler's encoder does, so its version is part of the key too
+        version = __version__ + '+assembler' + assembler_version if options.get('hack') else __version__
+        key = cache.key('VMTranslator', version, {k: v for k, v in options.items() if k != 'jobs'},
+                        *[os.path.basename(source) + file_digest(source) for source in sources])
+        with stats.phase('cache'):
+            hit = cache.restore(key, outputs)
+        if hit:
+            stats.count('cache_hits')
+            return outputs[0]
+    if options.get('hack'):
+        translateHack(sources, filepath, stats, options)
+    else:
+        translateText(sources, filepath, stats, options)
+    if cache is not None:
+        cache.store(key, outputs)
+    return outputs[0]
 
-        #increment line count and write to file
+def map_path(filepath):
+    """
+    String -> String
+    >>> map_path('prog/Main.asm')
+    'prog/Main.map'
+    """
+    return os.path.splitext(filepath)[0] + '.map'
+
+def translateText(sources, filepath, stats=NULL_STATS, options=None):
+    """
+    Writes the .asm for sources to filepath, each command preceded by its VM line as a comment unless the
+    comments option is False
+    """
+    options = options or {}
+    comments = options.get('comments', True)
+    with open(filepath, 'w') as outf:
+        if options.get('map'):
+            source_map = SourceMap()
+            pieces = translatePieces(sources, stats, options, source_map)
+            if stats.enabled:
+                pieces = list(pieces) #the translation phases run here, so the write is timed on its own
+            with stats.phase('write'):
+                outf.writelines(pieces)
+                source_map.dump(map_path(filepath))
+            return
+        #write initial setup code
+        outf.write(make_writer(BOOTSTRAP, options).asm_init())
+        if options.get('prune') or options.get('inline'):
+            translateProgram(sources, outf, stats, options)
+        elif options.get('jobs'):
+            texts = poolSources(sources, stats, options)
+            with stats.phase('write'):
+                outf.writelines(texts)
         else:
-            line_no += 1
-            if p.line:
-                if not p.line.startswith("//"):
-                    outf.write("\n//" + line + commandString)
+            for source in sources:
+                translateFile(make_writer(namespace(source), options), source, outf, stats, options.get('optimize', False),
+                              comments)
+                stats.count('files')
+
+def translateHack(sources, filepath, stats=NULL_STATS, options=None):
+    """
+    Translates and assembles sources in one process: the assembly for each command goes straight to the
+    assembler's Encoder, which lexes each distinct piece once, and the words are written next to filepath
+    as a .hack (.bin with the binary option). Nothing is written to filepath itself unless the asm option
+    asks for it, and without it the VM comments are never generated; the asm lines of a map are then those
+    of the .asm that asm would write without comments
+    """
+    options = options or {}
+    encoder = Encoder()
+    source_map = SourceMap() if options.get('map') else None
+    pieces = translatePieces(sources, stats, dict(options, comments=bool(options.get('asm') and options.get('comments', True))),
+                             source_map)
+    if stats.enabled:
+        pieces = list(pieces) #the translation phases run here, so encoding and writing are timed on their own
+        if options.get('asm'):
+            with stats.phase('write'), open(filepath, 'w') as outf:
+                outf.writelines(pieces)
+        with stats.phase('encode'):
+            for piece in pieces:
+                encoder.add(piece)
+    elif options.get('asm'):
+        with open(filepath, 'w') as outf:
+            for piece in pieces:
+                outf.write(piece)
+                encoder.add(piece)
+    else:
+        for piece in pieces:
+            encoder.add(piece)
+    with stats.phase('resolve'):
+        encoder.resolve()
+    with stats.phase('write'):
+        file_write(encoder.words, filepath, binary=options.get('binary'))
+        if source_map is not None:
+            source_map.dump(map_path(filepath))
+    stats.count('words', len(encoder.words))
+
+def translatePieces(sources, stats=NULL_STATS, options=None, source_map=None):
+    """
+    List of Strings, Dict, SourceMap -> Iterable of Strings
+    The startup code, then the assembly of each source command by command (file by file with jobs).
+    With a source map, every piece is added to it as it is yielded. With stats, each file's parse and codegen
+    phases run before its first piece is yielded, so the caller must not time the pieces as a phase of its own
+    """
+    options = options or {}
+    comments = options.get('comments', True)
+    init = make_writer(BOOTSTRAP, options).asm_init()
+    if source_map is not None:
+        source_map.add_piece(init)
+    yield init
+    if options.get('prune') or options.get('inline'):
+        for source, commands in zip(sources, wholeProgram(sources, stats, options)):
+            pieces = translateCommands(make_writer(namespace(source), options), commands, source, comments, source_map)
+            if stats.enabled:
+                with stats.phase('codegen'):
+                    pieces = list(pieces)
+            yield from pieces
+    elif options.get('jobs'):
+        yield from poolSources(sources, stats, options, source_map)
+    else:
+        for source in sources:
+            code = make_writer(namespace(source), options)
+            with open(source, 'r') as lines:
+                if stats.enabled:
+                    with stats.phase('read'):
+                        lines = lines.readlines()
+                    yield from timedCommands(code, lines, source, stats, options.get('optimize', False), comments, source_map)
                 else:
-                    outf.write(line)
+                    yield from translateLines(code, lines, source, options.get('optimize', False), comments, source_map)
+            stats.count('files')
+
+def translate(source, filename='Main.vm', init=True, **options):
     """
-    infinite loop addition for early nand2tetris tests
-    outf.write("\n(INFINITE_LOOP)\n" \
-                "@INFINITE_LOOP\n"
-                "0;JMP")
+    String or Iterable of Strings -> String
+    Translates VM code to assembly entirely in memory, optionally preceded by the startup code.
+    filename names the statics; takes the same options as translatePath
     """
+    if isinstance(source, str):
+        source = source.splitlines(keepends=True)
+    asm = [make_writer(BOOTSTRAP, options).asm_init()] if init else []
+    asm.extend(translateLines(make_writer(namespace(filename), options), source, filename, options.get('optimize', False),
+                              options.get('comments', True)))
+    return ''.join(asm)
 
-class Parser(object):
-    def __init__(self, line):
-        #removes comments and extra space
-        self.line = re.sub("(//).+", "", line).strip()
+def namespace(inf):
+    """
+    String -> String
+    dir/Main.vm -> Main, the prefix of the file's statics
+    """
+    return os.path.splitext(os.path.basename(inf))[0]
+
+def make_writer(filename, options):
+    """
+    String, Dict -> CodeWriter
+    """
+    return (TopOfStackCodeWriter if options.get('top_in_d') else CodeWriter)(filename, options.get('shared_routines', False))
 
-    def command_type(self):
-        command_types = {'push': 'C_PUSH', 'pop': 'C_POP', ('add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not'): 'C_ARITHMETIC', 
-        'label': 'C_LABEL', 'goto': 'C_GOTO', 'if-goto': 'C_IF', 'function': 'C_FUNCTION', 'return': 'C_RETURN', 'call': 'C_CALL'}
+def translateSource(inf, options):
+    """
+    String, Dict -> String
+    The assembly for one .vm file; runs in the worker processes of translatePath
+    """
+    with open(inf, 'r') as lines:
+        return ''.join(translateLines(make_writer(namespace(inf), options), lines, inf, options.get('optimize', False),
+                                      options.get('comments', True)))
+
+def poolSource(inf, options, mapped=False, timed=False):
+    """
+    String, Dict, Boolean, Boolean -> String, SourceMap or None, Stats or None
+    translateSource with, if asked, the map of its assembly (as if it started the program) and the Stats of
+    its phases; runs in the worker processes of poolSources
+    """
+    source_map = SourceMap() if mapped else None
+    code = make_writer(namespace(inf), options)
+    optimize, comments = options.get('optimize', False), options.get('comments', True)
+    stats = None
+    with open(inf, 'r') as lines:
+        if timed:
+            stats = Stats(inf)
+            with stats.phase('read'):
+                lines = lines.readlines()
+            text = ''.join(timedCommands(code, lines, inf, stats, optimize, comments, source_map))
+        else:
+            text = ''.join(translateLines(code, lines, inf, optimize, comments, source_map))
+    return text, source_map, stats
+
+def poolSources(sources, stats=NULL_STATS, options=None, source_map=None):
+    """
+    List of Strings, Dict, SourceMap -> List of Strings
+    The assembly of each source, translated by a pool of options['jobs'] workers. The maps and Stats the
+    workers return are added to source_map and stats; worker phases add up, so they can exceed the wall clock
+    """
+    with Pool(options['jobs']) as pool:
+        if source_map is None and not stats.enabled:
+            texts = pool.starmap(translateSource, [(source, options) for source in sources])
+        else:
+            texts = []
+            for text, file_map, file_stats in pool.starmap(poolSource, [(source, options, source_map is not None, stats.enabled)
+                                                                      for source in sources]):
+                if file_map is not None:
+                    source_map.extend(file_map)
+                if file_stats is not None:
+                    stats.merge(file_stats)
+                texts.append(text)
+    stats.count('files', len(sources))
+    return texts
+
+def generate(inf, commands, options):
+    """
+    String, List of Commands, Dict -> String
+    The assembly for one file's commands; runs in the worker processes of translateProgram
+    """
+    return ''.join(translateCommands(make_writer(namespace(inf), options), commands, inf, options.get('comments', True)))
+
+def translateFile(code, inf, outf, stats=NULL_STATS, optimize=False, comments=True):
+    with open(inf, 'r') as lines:
+        if not stats.enabled:
+            commandStrings = translateLines(code, lines, inf, optimize, comments)
+            while True: #one write per WRITE_BATCH commands rather than one per command
+                batch = ''.join(islice(commandStrings, WRITE_BATCH))
+                if not batch:
+                    return
+                outf.write(batch)
+        with stats.phase('read'):
+            lines = lines.readlines()
+    commandStrings = timedCommands(code, lines, inf, stats, optimize, comments)
+    with stats.phase('write'):
+        outf.writelines(commandStrings)
+
+def timedCommands(code, lines, inf, stats, optimize=False, comments=True, source_map=None):
+    """
+    List of Strings, Stats -> List of Strings
+    translateLines for --stats: each phase runs over the whole file so it can be timed on its own, and the
+    lines and the commands of each type are counted
+    """
+    with stats.phase('parse'):
+        commands = list(parseLines(lines, inf))
+    if optimize:
+        with stats.phase('optimize'):
+            commands = list(VMOptimizer.optimize(commands))
+    with stats.phase('codegen'):
+        commandStrings = list(translateCommands(code, commands, inf, comments, source_map))
+    stats.count('lines', len(lines))
+    for command in commands:
+        stats.count(command.type)
+    return commandStrings
+
+def translateProgram(sources, outf, stats=NULL_STATS, options=None):
+    """
+    Translates every source as one program, for the whole-program options of translatePath (inline, prune)
+    """
+    options = options or {}
+    programs = wholeProgram(sources, stats, options)
+    with stats.phase('codegen'):
+        tasks = [(source, commands, options) for source, commands in zip(sources, programs)]
+        if options.get('jobs'):
+            with Pool(options['jobs']) as pool:
+                commandStrings = pool.starmap(generate, tasks)
+        else:
+            commandStrings = [generate(*task) for task in tasks]
+    with stats.phase('write'):
+        outf.writelines(commandStrings)
+
+def wholeProgram(sources, stats=NULL_STATS, options=None):
+    """
+    List of Strings, Dict -> List of Lists of Commands
+    The commands of every source after the whole-program passes (inline, prune)
+    """
+    options = options or {}
+    programs = []
+    with stats.phase('parse'):
+        for source in sources:
+            with open(source, 'r') as lines:
+                lines = lines.readlines()
+            commands = list(parseLines(lines, source))
+            stats.count('lines', len(lines))
+            if options.get('optimize'):
+                commands = list(VMOptimizer.optimize(commands))
+            programs.append(commands)
+            stats.count('files')
+    if options.get('inline'):
+        with stats.phase('inline'):
+            programs = VMOptimizer.optimize_calls(programs, options['inline'])
+    if options.get('prune'):
+        with stats.phase('prune'):
+            graph = VMOptimizer.call_graph(programs)
+            if 'Sys.init' in graph:
+                live = VMOptimizer.live_functions(graph)
+                programs = [list(VMOptimizer.prune(commands, live)) for commands in programs]
+                stats.count('functions_pruned', sum(1 for function in graph if function is not None and function not in live))
+            else:
+                logging.warning("No Sys.init in the program; nothing was pruned.")
+    if stats.enabled:
+        for commands in programs:
+            for command in commands:
+                stats.count(command.type)
+    return programs
+
+def translateLines(code, lines, inf, optimize=False, comments=True, source_map=None):
+    """
+    Iterable of Strings -> Iterable of Strings
+    Yields the assembly for each VM line, preceded by the VM line as a comment unless comments is False
+    """
+    commands = parseLines(lines, inf)
+    if optimize:
+        commands = VMOptimizer.optimize(commands)
+    return translateCommands(code, commands, inf, comments, source_map)
+
+def translateCommands(code, commands, inf, comments=True, source_map=None):
+    """
+    Iterable of Commands -> Iterable of Strings
+    Picks the CodeWriter method for each command with a single lookup in its dispatch table.
+    With a source map, each piece is added to it with the file, line and function of its command
+    """
+    dispatch = code.dispatch
+    file, origin = os.path.basename(inf), None
+    for command in commands:
         try:
-            return next(v for k, v in command_types.items() if self.arg1() in k)
+            commandString = dispatch[command.type](command)
         except Exception:
-            logging.exception("Not a valid command type.")
+            logging.exception(f"Error on {inf} line {command.line_no}.")
+        else:
+            #some templates end without a newline; the one in front keeps them apart when joined
+            commandString = "\n//" + command.source + "\n" + commandString if comments else "\n" + commandString
+            if source_map is not None:
+                origin = (file, command.line_no, code.function_name or None) #asm_function has set the name
+                source_map.add_piece(commandString, origin)
+            yield commandString
+    tail = code.flush() #nothing may stay in registers past the end of a file
+    if tail:
+        if source_map is not None:
+            source_map.add_piece(tail, origin)
+        yield tail
+    """
+    infinite loop addition for early nand2tetris tests
+    outf.write("\n(INFINITE_LOOP)\n" \
+                "@INFINITE_LOOP\n"
+                "0;JMP")
+    """
 
-    def arg1(self):
-        """
-        String -> String
-        """
-        return self.line.strip().split()[0]
-    
-    def arg2(self):
-        """
-        String -> String
-        Returns 'static' in push static i OR 'LCL' in pop local i
-        """
-        memory_abbreviations = {'local': 'LCL', 'argument': 'ARG', 'this': 'THIS', 'that': 'THAT'}
-        var = self.line.split()[1] # 'static' or 'constant'
-        return memory_abbreviations[var] if var in memory_abbreviations else var
-    
-    def arg3(self):
-        """
-        String -> Int
-        Returns i in 'push constant i' or 'pop static i'
-        """
-        return int(self.line.split()[2])
+#top-of-stack mode: the second operand is in D and the result stays there
+TOP_ARITHMETIC = {'add': "@SP\nAM=M-1\nD=M+D\n", 'sub': "@SP\nAM=M-1\nD=M-D\n",
+                  'and': "@SP\nAM=M-1\nD=M&D\n", 'or': "@SP\nAM=M-1\nD=M|D\n",
+                  'neg': "D=-D\n", 'not': "D=!D\n"}
+TOP_COMPARE_TEMPLATE = "@SP\n" \
+                        "AM=M-1\n" \
+                        "D=M-D\n" \
+                        "@OUTPUT_TRUE_{n}\n" \
+                        "D;J{jump}\n" \
+                        "D=0\n" \
+                        "@NEXT_COMMAND_{n}\n" \
+                        "0;JMP\n" \
+                        "(OUTPUT_TRUE_{n})\n" \
+                        "D=-1\n" \
+                        "(NEXT_COMMAND_{n})\n"
+#shared routines (CodeWriter.asm_routines). $CALL pushes the return address in D and the caller's frame,
+#points ARG nArgs + 5 (R14) below SP and jumps to the function in R13
+CALL_ROUTINE = "($CALL)\n" \
+                "@SP\n" \
+                "A=M\n" \
+                "M=D\n" + \
+                "".join("@" + pointer + "\n"
+                        "D=M\n"
+                        "@SP\n"
+                        "AM=M+1\n"
+                        "M=D\n" for pointer in ('LCL', 'ARG', 'THIS', 'THAT')) + \
+                "@SP\n" \
+                "MD=M+1\n" \
+                "@R14\n" \
+                "D=D-M\n" \
+                "@ARG\n" \
+                "M=D\n" \
+                "@SP\n" \
+                "D=M\n" \
+                "@LCL\n" \
+                "M=D\n" \
+                "@R13\n" \
+                "A=M\n" \
+                "0;JMP\n"
+#$COMPARE_EQ/GT/LT replace the top two stack entries with the result and jump back to the address in D
+COMPARE_ROUTINE_TEMPLATE = "($COMPARE_{op})\n" \
+                            "@R15\n" \
+                            "M=D\n" \
+                            "@SP\n" \
+                            "AM=M-1\n" \
+                            "D=M\n" \
+                            "A=A-1\n" \
+                            "D=M-D\n" \
+                            "M=-1\n" \
+                            "@$COMPARE_{op}_END\n" \
+                            "D;J{op}\n" \
+                            "@SP\n" \
+                            "A=M-1\n" \
+                            "M=0\n" \
+                            "($COMPARE_{op}_END)\n" \
+                            "@R15\n" \
+                            "A=M\n" \
+                            "0;JMP\n"
+#copies the word after the one R13 points at to the word after the one R14 points at, advancing both
+MOVE_WORD = "@R13\n" \
+            "AM=M+1\n" \
+            "D=M\n" \
+            "@R14\n" \
+            "AM=M+1\n" \
+            "M=D\n"
+#push D onto the stack / pop the stack into D
+PUSH_D = "@SP\n" \
+        "M=M+1\n" \
+        "A=M-1\n" \
+        "M=D\n"
+POP_D = "@SP\n" \
+        "AM=M-1\n" \
+        "D=M\n"
+#largest LCL/ARG/THIS/THAT index reached by stepping A (one instruction per step) instead of adding it
+#through D; beyond these the step chain is longer than the general code
+PUSH_CHAIN_LIMIT = 3
+POP_CHAIN_LIMIT = 6
+#eq/gt/lt need labels unique to each use, so they are filled in from a template instead of cached
+COMPARE_TEMPLATE = "@SP\n" \
+                    "M=M-1\n" \
+                    "A=M\n" \
+                    "D=M\n" \
+                    "@SP\n" \
+                    "M=M-1\n" \
+                    "A=M\n" \
+                    "D=M-D\n" \
+                    "@OUTPUT_TRUE_{n}\n" \
+                    "D;J{jump}\n" \
+                    "D=0\n" \
+                    "@NEXT_COMMAND_{n}\n" \
+                    "0;JMP\n" \
+                    \
+                    "(OUTPUT_TRUE_{n})\n" \
+                    "D=-1\n" \
+                    "@NEXT_COMMAND_{n}\n" \
+                    "0;JMP\n" \
+                    \
+                    "(NEXT_COMMAND_{n})\n" \
+                    "@SP\n" \
+                    "A=M\n" \
+                    "M=D\n" \
+                    "@SP\n" \
+                    "M=M+1\n"
 
 class CodeWriter(object):
-    def __init__(self, filename):
+    def __init__(self, filename, shared_routines=False):
         self.compareCounter = 0 #increments every time two stack numbers are compared; ensures no duplicate variable names
         self.callCounter = 0 #increments every time function is called; ensures no duplicate function names
-        self.staticsCounter = 0 #increments every time new '.vm' file is opened for translation; ensures no duplicate static names
-        self.filename = filename #argument passed to CodeWriter
-        self.function_name = '' #necessary to create label_name
-        self.label_name = self.filename + '.' + self.function_name #once code object is created
-                                                                    #this label_name does not update
-        self.fixed_memory_locations = AssemblyTable.AssemblyTable()
+        #the .vm file's name without extension (Main for Main.vm): statics are Main.i, and the compare labels
+        #carry it too, so each file can be translated on its own, by its own CodeWriter
+        self.filename = filename
+        self.function_name = '' #the function being translated; labels are function$label
+        self.fixed_memory_locations = SymbolTable()
         self.additional_memory_locations = {'pointer': 3, 'temp': 5}
+        self.shared_routines = shared_routines #call/return/compare jump to one copy emitted by asm_init
+        #assembly already generated for (push/pop, segment, index) and arithmetic commands; the output of
+        #these depends only on the key (and, for statics, on the file), so each is built once per translator
+        self.pushpop_cache = {}
+        self.arithmetic_cache = {}
+        self.return_cache = None
+        self.dispatch = {
+            C_ARITHMETIC: lambda c: self.asm_arithmetic(c.arg1),
+            C_PUSH: lambda c: self.asm_pushpop(c.arg1, c.arg2, c.arg3),
+            C_POP: lambda c: self.asm_pushpop(c.arg1, c.arg2, c.arg3),
+            C_LABEL: lambda c: self.asm_label(c.arg2),
+            C_GOTO: lambda c: self.asm_goto(c.arg2),
+            C_IF: lambda c: self.asm_if(c.arg2),
+            C_FUNCTION: lambda c: self.asm_function(c.arg2, c.arg3),
+            C_CALL: lambda c: self.asm_call(c.arg2, c.arg3),
+            C_RETURN: lambda c: self.asm_return(),
+            C_MOVE: lambda c: self.asm_move(c.arg2, c.arg3),
+            C_INLINE_ENTER: lambda c: self.asm_inline_enter(*c.arg3),
+            C_INLINE_EXIT: lambda c: self.asm_inline_exit(c.arg3),
+            C_TAILCALL: lambda c: self.asm_tailcall(c.arg2, *c.arg3),
+        }
 
     def asm_init(self):
         init_setup_lines = "//Startup code\n" \
@@ -159,9 +619,38 @@ class CodeWriter(object):
                             "@THAT\n" \
                             "M=D\n" + \
                             self.asm_call('Sys.init', 0)
+        if self.shared_routines:
+            init_setup_lines += self.asm_routines()
         return init_setup_lines
 
+    def asm_routines(self):
+        """
+        The shared $CALL, $RETURN and $COMPARE_* routines, behind a halt loop so Sys.init never falls into them.
+        Trade-off: each call site shrinks from 47 instructions to 12, each return from 49 to 2 and each eq/gt/lt
+        from 21 to 4, but every call executes 1 more instruction and every return 2 more, for the jumps into
+        and out of the routine (comparisons run 1-2 fewer). With top_in_d, a comparison also has to write
+        the top of the stack back to RAM first, so that mode gives up most of its savings on comparisons
+        """
+        routines = "\n//Shared routines\n" \
+                    "($HALT)\n" \
+                    "@$HALT\n" \
+                    "0;JMP\n" + \
+                    CALL_ROUTINE + \
+                    "($RETURN)\n" + self.build_return()
+        for operator in ('eq', 'gt', 'lt'):
+            routines += COMPARE_ROUTINE_TEMPLATE.format(op=operator.upper())
+        return routines
+
     def asm_arithmetic(self, arg1):
+        if arg1 in ('gt', 'lt', 'eq'):
+            return self.compare_op(arg1) #a fresh pair of labels every time, so never cached
+        try:
+            return self.arithmetic_cache[arg1]
+        except KeyError:
+            convertedLine = self.arithmetic_cache[arg1] = self.build_arithmetic(arg1)
+            return convertedLine
+
+    def build_arithmetic(self, arg1):
         if arg1 == 'add':
             return self.combine_op('+')
         elif arg1 == 'sub':
@@ -174,8 +663,6 @@ class CodeWriter(object):
             return self.single_op('-')
         elif arg1 == 'not':
             return self.single_op('!')
-        elif arg1 in ('gt', 'lt', 'eq'):
-            return self.compare_op(arg1)
         else:
             logging.exception('Improper arithmetic command used.')
 
@@ -202,31 +689,15 @@ class CodeWriter(object):
         return convertedLine
 
     def compare_op(self, operator):
-        convertedLine = "@SP\n" \
-                        "M=M-1\n" \
-                        "A=M\n" \
-                        "D=M\n" \
-                        "@SP\n" \
-                        "M=M-1\n" \
-                        "A=M\n" \
-                        "D=M-D\n" \
-                        "@OUTPUT_TRUE_" + str(self.compareCounter) + "\n" \
-                        "D;J" + operator.upper() + "\n" \
-                        "D=0\n" \
-                        "@NEXT_COMMAND_" + str(self.compareCounter) + "\n" \
-                        "0;JMP\n" \
-                        \
-                        "(OUTPUT_TRUE_" + str(self.compareCounter) + ")" + "\n" \
-                        "D=-1\n" \
-                        "@NEXT_COMMAND_" + str(self.compareCounter) + "\n" \
-                        "0;JMP\n" \
-                        \
-                        "(NEXT_COMMAND_" + str(self.compareCounter) + ")" + "\n" \
-                        "@SP\n" \
-                        "A=M\n" \
-                        "M=D\n" \
-                        "@SP\n" \
-                        "M=M+1\n"
+        if self.shared_routines:
+            retAddr = "COMPARE_RETURN_" + self.filename + "." + str(self.compareCounter)
+            self.compareCounter += 1
+            return "@" + retAddr + "\n" \
+                    "D=A\n" \
+                    "@$COMPARE_" + operator.upper() + "\n" \
+                    "0;JMP\n" \
+                    "(" + retAddr + ")\n"
+        convertedLine = COMPARE_TEMPLATE.format(n=self.filename + "." + str(self.compareCounter), jump=operator.upper())
         self.compareCounter += 1
         return convertedLine
 
@@ -251,7 +722,7 @@ class CodeWriter(object):
             first_lines = "@" + str(arg3) + "\n" \
                             "D=A\n"
         elif arg2 == 'static':
-            first_lines = "@" + self.filename + "." + 'static' + str(self.staticsCounter) + str(arg3) + "\n" \
+            first_lines = "@" + self.filename + "." + str(arg3) + "\n" \
                             "D=A\n"
         elif arg2 in ('temp', 'pointer'):
             first_lines = "@" + str(arg3) + "\n" \
@@ -264,47 +735,104 @@ class CodeWriter(object):
         return first_lines
 
     def asm_pushpop(self, arg1, arg2, arg3):
+        key = (arg1, arg2, arg3)
+        try:
+            return self.pushpop_cache[key]
+        except KeyError:
+            convertedLine = self.pushpop_cache[key] = self.build_pushpop(arg1, arg2, arg3)
+            return convertedLine
+
+    def build_pushpop(self, arg1, arg2, arg3):
         if arg1 == 'push':
-            if arg2 == 'constant':
-                second_lines = "@SP\n" \
-                            "A=M\n" \
-                            "M=D\n" \
-                            "@SP\n" \
-                            "M=M+1\n"
-            else:
-                second_lines = "@addr\n" \
-                            "M=D\n" \
-                            "A=M\n" \
-                            "D=M\n" \
-                            "@SP\n" \
-                            "A=M\n" \
-                            "M=D\n" \
-                            "@SP\n" \
-                            "M=M+1\n"
-            return self.pushpop_firstlines(arg2, arg3) + second_lines
+            if arg2 == 'constant' and arg3 in (-1, 0, 1): #the ALU has these constants, so nothing goes through D
+                return "@SP\n" \
+                        "M=M+1\n" \
+                        "A=M-1\n" \
+                        "M=" + str(arg3) + "\n"
+            return self.load_d(arg2, arg3) + PUSH_D
         elif arg1 == 'pop':
-            second_lines = "@addr\n" \
-                            "M=D\n" \
-                            "@SP\n" \
-                            "M=M-1\n" \
-                            "A=M\n" \
-                            "D=M\n" \
-                            "@addr\n" \
+            load_address = self.segment_address(arg2, arg3, POP_CHAIN_LIMIT)
+            if load_address is not None:
+                return POP_D + load_address + "M=D\n"
+            #the address has to be worked out before the pop overwrites D, so it waits in R13
+            second_lines = "@R13\n" \
+                            "M=D\n" + POP_D + \
+                            "@R13\n" \
                             "A=M\n" \
                             "M=D\n"
             return self.pushpop_firstlines(arg2, arg3) + second_lines
 
+    def load_d(self, arg2, arg3):
+        """
+        String, Int -> String
+        Lines that load a constant or a segment entry into D
+        """
+        if arg2 == 'constant':
+            if arg3 in (-1, 0, 1):
+                return "D=" + str(arg3) + "\n"
+            elif arg3 < 0: #only the optimizer folds to negative constants; A-instructions hold 0..32767
+                return "@" + str(~arg3) + "\n" \
+                        "D=!A\n"
+            return "@" + str(arg3) + "\n" \
+                    "D=A\n"
+        load_address = self.segment_address(arg2, arg3, PUSH_CHAIN_LIMIT)
+        if load_address is not None:
+            return load_address + "D=M\n"
+        return self.pushpop_firstlines(arg2, arg3) + "A=D\n" \
+                                                    "D=M\n"
+
+    def asm_move(self, source, target):
+        """
+        (String, Int), (String, Int) -> String
+        push source / pop target without going through the stack
+        """
+        store_address = self.segment_address(target[0], target[1], POP_CHAIN_LIMIT)
+        if store_address is not None:
+            return self.load_d(*source) + store_address + "M=D\n"
+        return self.pushpop_firstlines(*target) + "@R13\n" \
+                                                "M=D\n" + \
+                self.load_d(*source) + "@R13\n" \
+                                        "A=M\n" \
+                                        "M=D\n"
+
+    def segment_address(self, arg2, arg3, chain_limit):
+        """
+        String, Int, Int -> String or None
+        Lines that point A at a segment entry without touching D, or None when that is not cheaper.
+        temp, pointer and static addresses are known now; LCL/ARG/THIS/THAT entries up to
+        chain_limit are reached by stepping A up from the base pointer
+        """
+        if arg2 in ('temp', 'pointer'):
+            return "@R" + str(self.additional_memory_locations[arg2] + arg3) + "\n"
+        elif arg2 == 'static':
+            return "@" + self.filename + "." + str(arg3) + "\n"
+        elif arg2 in ('LCL', 'ARG', 'THIS', 'THAT') and arg3 <= chain_limit:
+            if arg3 == 0:
+                return "@" + arg2 + "\n" \
+                        "A=M\n"
+            return "@" + arg2 + "\n" \
+                    "A=M+1\n" + \
+                    (arg3 - 1) * "A=A+1\n"
+        return None
+
+    def label(self, arg2):
+        """
+        String -> String
+        VM labels are scoped to their function: LOOP in Main.main is Main.main$LOOP
+        """
+        return (self.function_name or self.filename) + "$" + arg2
+
     def asm_label(self, arg2):
         """
         label label
         """
-        return "(" + self.label_name + arg2 + ")\n"
+        return "(" + self.label(arg2) + ")\n"
 
     def asm_goto(self, arg2):
         """
         goto label
         """
-        return "@" + self.label_name + arg2 + "\n" \
+        return "@" + self.label(arg2) + "\n" \
                 "0;JMP\n"
 
     def asm_if(self, arg2):
@@ -315,7 +843,7 @@ class CodeWriter(object):
                         "M=M-1\n" \
                         "A=M\n" \
                         "D=M\n" \
-                        "@" + self.label_name + arg2 + "\n" \
+                        "@" + self.label(arg2) + "\n" \
                         "D; JNE\n"
         return convertedLine
 
@@ -324,7 +852,7 @@ class CodeWriter(object):
         function function_name nVars
         """
         self.function_name = arg2
-        return "(" + self.filename + '.' + self.function_name + ")\n" + \
+        return "(" + self.function_name + ")\n" + \
                 (arg3 * self.asm_pushpop('push','constant', 0)) # push constant 0 as LCL variables arg3 times
 
     def save_mem_space(self):
@@ -341,9 +869,23 @@ class CodeWriter(object):
         """
         call function_name nArgs
         """
-        self.function_name = arg2
         self.callCounter +=1
-        retAddr = self.filename + '.' + self.function_name +'$ret.' + str(self.callCounter)
+        retAddr = (self.function_name or self.filename) + '$ret.' + str(self.callCounter)
+        if self.shared_routines:
+            #$CALL takes the function in R13, nArgs + 5 in R14 and the return address in D
+            return "@" + arg2 + "\n" \
+                    "D=A\n" \
+                    "@R13\n" \
+                    "M=D\n" \
+                    "@" + str(arg3 + 5) + "\n" \
+                    "D=A\n" \
+                    "@R14\n" \
+                    "M=D\n" \
+                    "@" + retAddr + "\n" \
+                    "D=A\n" \
+                    "@$CALL\n" \
+                    "0;JMP\n" \
+                    "(" + retAddr + ")"
         save_caller_frame = "//call. save_caller_frame\n" + \
                             "@" + retAddr + "\n" \
                             "D=A\n" + \
@@ -380,10 +922,134 @@ class CodeWriter(object):
                         "D=M\n" \
                         "@LCL\n" \
                         "M=D\n"
-        goto_called_function = self.asm_goto(arg2)
-       
+        goto_called_function = "@" + arg2 + "\n" \
+                                "0;JMP\n"
+
         return save_caller_frame + set_new_arg + set_new_lcl + goto_called_function + "(" + retAddr + ")"
 
+    def asm_inline_enter(self, nArgs, nVars, save_pointers):
+        """
+        Start of an inlined function body: saves LCL and ARG (and THIS/THAT when the body sets them) on the
+        stack like a call would, without the return address or the jump
+        """
+        saved = ('LCL', 'ARG', 'THIS', 'THAT') if save_pointers else ('LCL', 'ARG')
+        convertedLine = "".join("@" + pointer + "\n"
+                                "D=M\n" + PUSH_D for pointer in saved)
+        return convertedLine + "@SP\n" \
+                                "D=M\n" \
+                                "@" + str(len(saved) + nArgs) + "\n" \
+                                "D=D-A\n" \
+                                "@ARG\n" \
+                                "M=D\n" \
+                                "@SP\n" \
+                                "D=M\n" \
+                                "@LCL\n" \
+                                "M=D\n" + \
+                (nVars * self.build_pushpop('push', 'constant', 0))
+
+    def asm_inline_exit(self, save_pointers):
+        """
+        return from an inlined function body: the value goes to the first argument's place, SP just above it
+        """
+        restore = "".join(POP_D + "@" + pointer + "\n"
+                                  "M=D\n" for pointer in (('THAT', 'THIS') if save_pointers else ()))
+        return POP_D + "@R13\n" \
+                        "M=D\n" \
+                        "@LCL\n" \
+                        "D=M\n" \
+                        "@SP\n" \
+                        "M=D\n" + restore + POP_D + \
+                "@R14\n" \
+                "M=D\n" + POP_D + \
+                "@LCL\n" \
+                "M=D\n" \
+                "@R13\n" \
+                "D=M\n" \
+                "@ARG\n" \
+                "A=M\n" \
+                "M=D\n" \
+                "@ARG\n" \
+                "D=M+1\n" \
+                "@SP\n" \
+                "M=D\n" \
+                "@R14\n" \
+                "D=M\n" \
+                "@ARG\n" \
+                "M=D\n"
+
+    def asm_tailcall(self, arg2, arg3, caller_args=0):
+        """
+        call function_name nArgs, then return: the callee takes over the caller's frame, so the stack does not grow.
+        The arguments move down to ARG with the caller's saved frame right after them. When the caller is known
+        to have at least as many arguments (caller_args), both move straight down: cheaper than call + return.
+        Otherwise the frame is first copied above the arguments, costing about as much as call + return
+        """
+        if arg3 <= caller_args: #the new arguments end below the saved frame, so nothing is overwritten early
+            return "@LCL\n" \
+                    "D=M\n" \
+                    "@6\n" \
+                    "D=D-A\n" \
+                    "@R13\n" \
+                    "M=D\n" \
+                    "@ARG\n" \
+                    "D=M\n" \
+                    "@" + str(arg3) + "\n" \
+                    "D=D+A\n" \
+                    "@R14\n" \
+                    "M=D-1\n" + \
+                    5 * MOVE_WORD + \
+                    "@SP\n" \
+                    "D=M\n" \
+                    "@" + str(arg3 + 1) + "\n" \
+                    "D=D-A\n" \
+                    "@R13\n" \
+                    "M=D\n" \
+                    "@ARG\n" \
+                    "D=M-1\n" \
+                    "@R14\n" \
+                    "M=D\n" + \
+                    arg3 * MOVE_WORD + \
+                    "@ARG\n" \
+                    "D=M\n" \
+                    "@" + str(arg3 + 5) + "\n" \
+                    "D=D+A\n" \
+                    "@SP\n" \
+                    "M=D\n" \
+                    "@LCL\n" \
+                    "M=D\n" \
+                    "@" + arg2 + "\n" \
+                    "0;JMP\n"
+        return "@LCL\n" \
+                "D=M\n" \
+                "@6\n" \
+                "D=D-A\n" \
+                "@R13\n" \
+                "M=D\n" \
+                "@SP\n" \
+                "D=M-1\n" \
+                "@R14\n" \
+                "M=D\n" + \
+                5 * MOVE_WORD + \
+                "@SP\n" \
+                "D=M\n" \
+                "@" + str(arg3 + 1) + "\n" \
+                "D=D-A\n" \
+                "@R13\n" \
+                "M=D\n" \
+                "@ARG\n" \
+                "D=M-1\n" \
+                "@R14\n" \
+                "M=D\n" + \
+                (arg3 + 5) * MOVE_WORD + \
+                "@R14\n" \
+                "D=M+1\n" \
+                "@SP\n" \
+                "M=D\n" \
+                "@LCL\n" \
+                "M=D\n" \
+                "@" + arg2 + "\n" \
+                "0;JMP\n"
+
     def restore_mem_space(self, pointer):
         """
         only used for asm_return function to restore locations in callee's stack to caller's original memory values
@@ -400,6 +1066,20 @@ class CodeWriter(object):
         """
         return
         """
+        if self.shared_routines:
+            return "@$RETURN\n" \
+                    "0;JMP\n"
+        if self.return_cache is None:
+            self.return_cache = self.build_return()
+        return self.return_cache
+
+    def flush(self):
+        """
+        Code writing back anything held in registers; this CodeWriter keeps the whole stack in RAM
+        """
+        return ''
+
+    def build_return(self):
         endframe_equals_lcl = "@LCL\n" \
                                 "D=M\n" \
                                 "@endframe\n" \
@@ -430,5 +1110,95 @@ class CodeWriter(object):
         return endframe_equals_lcl + retAddr_designation + pop_arg_zero + move_sp + \
                 restore_that + restore_this + restore_arg + restore_lcl + goto_retaddr
 
+class TopOfStackCodeWriter(CodeWriter):
+    """
+    CodeWriter that keeps the top of the stack in D between commands instead of in RAM.
+    While top_in_d is set the stack in RAM is one entry short and SP points where that entry belongs;
+    it is written back (flushed) before labels, jumps, calls, returns and function entries,
+    where other code expects the whole stack in RAM
+    """
+    def __init__(self, filename, shared_routines=False):
+        super().__init__(filename, shared_routines)
+        self.top_in_d = False
+
+    def flush(self):
+        if not self.top_in_d:
+            return ''
+        self.top_in_d = False
+        return PUSH_D
+
+    def asm_arithmetic(self, arg1):
+        key = (arg1, self.top_in_d)
+        if arg1 in ('gt', 'lt', 'eq') and self.shared_routines:
+            return self.flush() + self.compare_op(arg1) #the shared routine leaves its result on the stack
+        if arg1 in ('gt', 'lt', 'eq'):
+            convertedLine = ('' if self.top_in_d else POP_D) + \
+                            TOP_COMPARE_TEMPLATE.format(n=self.filename + "." + str(self.compareCounter), jump=arg1.upper())
+            self.compareCounter += 1
+        else:
+            try:
+                convertedLine = self.arithmetic_cache[key]
+            except KeyError:
+                convertedLine = self.arithmetic_cache[key] = ('' if self.top_in_d else POP_D) + \
+                                                            TOP_ARITHMETIC[arg1]
+        self.top_in_d = True
+        return convertedLine
+
+    def asm_pushpop(self, arg1, arg2, arg3):
+        key = (arg1, arg2, arg3, self.top_in_d)
+        try:
+            convertedLine = self.pushpop_cache[key]
+        except KeyError:
+            convertedLine = self.pushpop_cache[key] = self.build_top_pushpop(arg1, arg2, arg3)
+        self.top_in_d = arg1 == 'push'
+        return convertedLine
+
+    def build_top_pushpop(self, arg1, arg2, arg3):
+        if arg1 == 'push':
+            return (PUSH_D if self.top_in_d else '') + self.load_d(arg2, arg3)
+        elif arg1 == 'pop':
+            load_address = self.segment_address(arg2, arg3, POP_CHAIN_LIMIT)
+            if load_address is not None:
+                return ('' if self.top_in_d else POP_D) + load_address + "M=D\n"
+            #the general code needs D for the address, so the value goes back to RAM first
+            return (PUSH_D if self.top_in_d else '') + self.build_pushpop(arg1, arg2, arg3)
+
+    def asm_move(self, source, target):
+        return self.flush() + super().asm_move(source, target)
+
+    def asm_inline_enter(self, nArgs, nVars, save_pointers):
+        return self.flush() + super().asm_inline_enter(nArgs, nVars, save_pointers)
+
+    def asm_inline_exit(self, save_pointers):
+        return self.flush() + super().asm_inline_exit(save_pointers)
+
+    def asm_tailcall(self, arg2, arg3, caller_args=0):
+        return self.flush() + super().asm_tailcall(arg2, arg3, caller_args)
+
+    def asm_label(self, arg2):
+        return self.flush() + super().asm_label(arg2)
+
+    def asm_goto(self, arg2):
+        return self.flush() + super().asm_goto(arg2)
+
+    def asm_if(self, arg2):
+        if not self.top_in_d:
+            return super().asm_if(arg2)
+        self.top_in_d = False
+        return "@" + self.label(arg2) + "\n" \
+                "D; JNE\n"
+
+    def asm_function(self, arg2, arg3):
+        flushed = self.flush()
+        self.function_name = arg2
+        return flushed + "(" + self.function_name + ")\n" + \
+                (arg3 * self.build_pushpop('push', 'constant', 0))
+
+    def asm_call(self, arg2, arg3):
+        return self.flush() + super().asm_call(arg2, arg3)
+
+    def asm_return(self):
+        return self.flush() + super().asm_return()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
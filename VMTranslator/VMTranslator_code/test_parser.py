@@ -1,5 +1,16 @@
-import unittest
-from VMTranslator import Parser, CodeWriter
+import unittest, os, sys, json, tempfile, subprocess
+from io import StringIO
+from unittest import mock
+from VMTranslator import Parser, CodeWriter, TopOfStackCodeWriter, Command, parse_command, parseLines, translate, translateFile, \
+    translatePath
+from VMOptimizer import optimize, optimize_calls
+from Linker import linkPath
+from VMInterpreter import VMInterpreter
+from assembler import assemble, assemble_parallel, hack_lines
+from SourceMap import SourceMap
+from Stats import Stats
+from SymbolTable import SymbolTable
+from BuildCache import BuildCache
 
 class ParserTest_command_type(unittest.TestCase):
     def test_command_type_push(self):
@@ -105,18 +116,18 @@ class CodeWriterTest_asm_arithmetic(unittest.TestCase):
                         "M=M-1\n" \
                         "A=M\n" \
                         "D=M-D\n" \
-                        "@OUTPUT_TRUE_0\n" \
+                        "@OUTPUT_TRUE_Foo.0\n" \
                         "D;JGT\n" \
                         "D=0\n" \
-                        "@NEXT_COMMAND_0\n" \
+                        "@NEXT_COMMAND_Foo.0\n" \
                         "0;JMP\n" \
                         \
-                        "(OUTPUT_TRUE_0)\n" \
+                        "(OUTPUT_TRUE_Foo.0)\n" \
                         "D=-1\n" \
-                        "@NEXT_COMMAND_0\n" \
+                        "@NEXT_COMMAND_Foo.0\n" \
                         "0;JMP\n" \
                         \
-                        "(NEXT_COMMAND_0)\n" \
+                        "(NEXT_COMMAND_Foo.0)\n" \
                         "@SP\n" \
                         "A=M\n" \
                         "M=D\n" \
@@ -135,18 +146,18 @@ class CodeWriterTest_asm_arithmetic(unittest.TestCase):
                         "M=M-1\n" \
                         "A=M\n" \
                         "D=M-D\n" \
-                        "@OUTPUT_TRUE_0\n" \
+                        "@OUTPUT_TRUE_Foo.0\n" \
                         "D;JLT\n" \
                         "D=0\n" \
-                        "@NEXT_COMMAND_0\n" \
+                        "@NEXT_COMMAND_Foo.0\n" \
                         "0;JMP\n" \
                         \
-                        "(OUTPUT_TRUE_0)\n" \
+                        "(OUTPUT_TRUE_Foo.0)\n" \
                         "D=-1\n" \
-                        "@NEXT_COMMAND_0\n" \
+                        "@NEXT_COMMAND_Foo.0\n" \
                         "0;JMP\n" \
                         \
-                        "(NEXT_COMMAND_0)\n" \
+                        "(NEXT_COMMAND_Foo.0)\n" \
                         "@SP\n" \
                         "A=M\n" \
                         "M=D\n" \
@@ -157,7 +168,20 @@ class CodeWriterTest_asm_othercommands(unittest.TestCase):
 
     def test_asm_pushpop(self):
         c = CodeWriter('Foo')
-        self.assertEqual(CodeWriter.asm_pushpop(c,'pop', 'static', '2'), '@Foo.static2\nD=A\n@addr\nM=D\n@SP\nM=M-1\nA=M\nD=M\n@addr\nA=M\nM=D\n')
+        self.assertEqual(CodeWriter.asm_pushpop(c,'pop', 'static', '2'), '@SP\nAM=M-1\nD=M\n@Foo.2\nM=D\n')
+
+    def test_asm_pushpop_direct_address(self):
+        c = CodeWriter('Foo')
+        self.assertEqual(c.asm_pushpop('push', 'temp', 3), '@R8\nD=M\n@SP\nM=M+1\nA=M-1\nM=D\n')
+        self.assertEqual(c.asm_pushpop('pop', 'pointer', 1), '@SP\nAM=M-1\nD=M\n@R4\nM=D\n')
+        self.assertEqual(c.asm_pushpop('pop', 'static', 2), '@SP\nAM=M-1\nD=M\n@Foo.2\nM=D\n')
+
+    def test_asm_pushpop_small_offsets(self):
+        c = CodeWriter('Foo')
+        self.assertEqual(c.asm_pushpop('push', 'LCL', 0), '@LCL\nA=M\nD=M\n@SP\nM=M+1\nA=M-1\nM=D\n')
+        self.assertEqual(c.asm_pushpop('pop', 'ARG', 2), '@SP\nAM=M-1\nD=M\n@ARG\nA=M+1\nA=A+1\nM=D\n')
+        self.assertEqual(c.asm_pushpop('pop', 'THAT', 9), '@9\nD=A\n@4\nD=M+D\n@R13\nM=D\n' \
+                                                          '@SP\nAM=M-1\nD=M\n@R13\nA=M\nM=D\n')
 
     def test_asm_pushpop_first_lines(self):
         c = CodeWriter('Foo')
@@ -165,14 +189,17 @@ class CodeWriterTest_asm_othercommands(unittest.TestCase):
 
     def test_asm_label(self):
         c = CodeWriter('Foo')
+        c.function_name = 'Foo.main'
         self.assertEqual(CodeWriter.asm_label(c,'LOOP'), '(Foo.main$LOOP)\n')
 
     def test_asm_goto(self):
         c = CodeWriter('Foo')
+        c.function_name = 'Foo.main'
         self.assertEqual(CodeWriter.asm_goto(c,'LOOP'), '@Foo.main$LOOP\n0;JMP\n')
 
     def test_asm_if(self):
         c = CodeWriter('Foo')
+        c.function_name = 'Foo.main'
         self.assertEqual(CodeWriter.asm_if(c,'LOOP'), 
                         "@SP\n" \
                         "M=M-1\n" \
@@ -184,54 +211,527 @@ class CodeWriterTest_asm_othercommands(unittest.TestCase):
 
     def test_asm_function_1localvar(self):
         c = CodeWriter('Foo')
-        self.assertEqual(CodeWriter.asm_function(c, 'bar', 1),
+        self.assertEqual(CodeWriter.asm_function(c, 'Foo.bar', 1),
                         "(Foo.bar)\n" \
-                        "@0\n" \
-                        "D=A\n" \
-                        "@SP\n" \
-                        "A=M\n" \
-                        "M=D\n" \
                         "@SP\n" \
-                        "M=M+1\n")
+                        "M=M+1\n" \
+                        "A=M-1\n" \
+                        "M=0\n")
 
     def test_asm_function_2localvar(self):
         c = CodeWriter('Foo')
-        self.assertEqual(CodeWriter.asm_function(c, 'bar', 2),
+        self.assertEqual(CodeWriter.asm_function(c, 'Foo.bar', 2),
                         "(Foo.bar)\n" \
-                        "@0\n" \
-                        "D=A\n" \
-                        "@SP\n" \
-                        "A=M\n" \
-                        "M=D\n" \
                         "@SP\n" \
                         "M=M+1\n" \
-                        "@0\n" \
-                        "D=A\n" \
+                        "A=M-1\n" \
+                        "M=0\n" \
                         "@SP\n" \
-                        "A=M\n" \
-                        "M=D\n" \
-                        "@SP\n" \
-                        "M=M+1\n")
+                        "M=M+1\n" \
+                        "A=M-1\n" \
+                        "M=0\n")
 
     def test_asm_callfunction(self):
         c = CodeWriter('testfile')
+        c.function_name = 'testfile.foo'
         self.maxDiff = None
-        self.assertEqual(CodeWriter.asm_call(c, 'bar', 2),
-                        "@testfile.bar$ret.0\n" \
-                        "@0\n" \
-                        "D=A\n" \
-                        "@SP\n" \
-                        "A=M\n" \
-                        "M=D\n" \
-                        "@SP\n" \
-                        "M=M+1\n" \
-                        "@0\n" \
-                        "D=A\n" \
-                        "@SP\n" \
-                        "A=M\n" \
-                        "M=D\n" \
-                        "@SP\n" \
-                        "M=M+1\n")
+        asm = CodeWriter.asm_call(c, 'bar', 2)
+        self.assertTrue(asm.startswith("//call. save_caller_frame\n" \
+                                       "@testfile.foo$ret.1\n" \
+                                       "D=A\n" \
+                                       "@SP\n" \
+                                       "A=M\n" \
+                                       "M=D\n" \
+                                       "@SP\n" \
+                                       "M=M+1\n"))
+        self.assertTrue(asm.endswith("//call. set_new_arg\n" \
+                                     "@SP\n" \
+                                     "D=M\n" \
+                                     "@7\n" \
+                                     "D=D-A\n" \
+                                     "@ARG\n" \
+                                     "M=D\n" \
+                                     "//call. set_new_lcl\n" \
+                                     "@SP\n" \
+                                     "D=M\n" \
+                                     "@LCL\n" \
+                                     "M=D\n" \
+                                     "@bar\n" \
+                                     "0;JMP\n" \
+                                     "(testfile.foo$ret.1)"))
+        self.assertIn('(testfile.foo$ret.2)', CodeWriter.asm_call(c, 'bar', 0))
+
+class ParseCommandTest(unittest.TestCase):
+    def test_parse_push_local(self):
+        self.assertEqual(parse_command('push local 2//this is a test\n'), Command('C_PUSH', 'push', 'LCL', 2))
+
+    def test_parse_arithmetic(self):
+        self.assertEqual(parse_command('  add \n'), Command('C_ARITHMETIC', 'add'))
+
+    def test_parse_label_ignores_extra_tokens(self):
+        self.assertEqual(parse_command('goto loop check'), Command('C_GOTO', 'goto', 'loop'))
+
+    def test_parse_function(self):
+        command = parse_command('function Main.main 3 // entry\n', 7)
+        self.assertEqual(command, Command('C_FUNCTION', 'function', 'Main.main', 3))
+        self.assertEqual((command.source, command.line_no), ('function Main.main 3 // entry', 7))
+
+    def test_parse_blank_and_comment(self):
+        self.assertIsNone(parse_command('   \n'))
+        self.assertIsNone(parse_command('// only a comment\n'))
+
+    def test_parse_temp_out_of_range(self):
+        self.assertEqual(parse_command('pop temp 7'), Command('C_POP', 'pop', 'temp', 7))
+        with self.assertRaises(ValueError):
+            parse_command('pop temp 11')
+        self.assertNotIn('@R16', translate('push constant 1\npop temp 11\n', init=False))
+
+    def test_parse_pointer_out_of_range(self):
+        self.assertEqual(parse_command('push pointer 1'), Command('C_PUSH', 'push', 'pointer', 1))
+        with self.assertRaises(ValueError):
+            parse_command('push pointer 2')
+        self.assertNotIn('@R5', translate('push pointer 2\n', init=False))
+
+    def test_parse_lines_skips_bad_lines(self):
+        self.assertEqual([c.line_no for c in parseLines(['push constant 1\n', 'jump somewhere\n', 'pop temp x\n', 'add\n'])],
+                        [1, 4])
+
+class TranslateTest(unittest.TestCase):
+    def test_translate_in_memory(self):
+        c = CodeWriter('Foo.asm')
+        self.assertEqual(translate('push constant 7\n// comment\n\nneg\n', 'Foo.asm', init=False),
+                        "\n//push constant 7\n" + c.asm_pushpop('push', 'constant', 7) + \
+                        "\n//neg\n" + c.asm_arithmetic('neg'))
+
+    def test_translate_lines_with_init(self):
+        asm = translate(['function Sys.init 0\n', 'label END\n', 'goto END\n'], 'Foo.vm')
+        self.assertTrue(asm.startswith(CodeWriter('$bootstrap').asm_init()))
+        self.assertIn("(Sys.init)", asm)
+        self.assertIn("(Sys.init$END)\n", asm)
+
+class ImportTest(unittest.TestCase):
+    def test_import_leaves_sys_path_alone(self):
+        here = os.path.dirname(os.path.abspath(__file__))
+        check = 'import sys; path = list(sys.path); import VMTranslator, Linker, VMInterpreter; print(sys.path == path)'
+        result = subprocess.run([sys.executable, '-c', check], cwd=here, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.stdout.strip(), 'True', result.stderr)
+
+class TemplateCacheTest(unittest.TestCase):
+    def test_repeated_pushpop_is_cached(self):
+        c = CodeWriter('Foo.asm')
+        first = c.asm_pushpop('push', 'LCL', 2)
+        self.assertIs(c.asm_pushpop('push', 'LCL', 2), first)
+        self.assertEqual(first, CodeWriter('Foo.asm').build_pushpop('push', 'LCL', 2))
+
+    def test_statics_cached_per_file(self):
+        first = CodeWriter('Foo').asm_pushpop('pop', 'static', 1)
+        self.assertIn('@Foo.1\n', first)
+        self.assertNotEqual(CodeWriter('Bar').asm_pushpop('pop', 'static', 1), first)
+
+    def test_compare_labels_stay_unique(self):
+        c = CodeWriter('Foo')
+        self.assertIn("@OUTPUT_TRUE_Foo.0\nD;JEQ\n", c.asm_arithmetic('eq'))
+        self.assertIn("(NEXT_COMMAND_Foo.1)\n", c.asm_arithmetic('eq'))
+
+class TopOfStackTest(unittest.TestCase):
+    def test_arithmetic_stays_in_d(self):
+        c = TopOfStackCodeWriter('Foo')
+        self.assertEqual(c.asm_pushpop('push', 'LCL', 0) + c.asm_pushpop('push', 'constant', 1) + \
+                        c.asm_arithmetic('add') + c.asm_pushpop('pop', 'LCL', 0),
+                        '@LCL\nA=M\nD=M\n' '@SP\nM=M+1\nA=M-1\nM=D\n' 'D=1\n' \
+                        '@SP\nAM=M-1\nD=M+D\n' '@LCL\nA=M\nM=D\n')
+        self.assertFalse(c.top_in_d)
+
+    def test_flush_at_control_flow(self):
+        c = TopOfStackCodeWriter('Foo')
+        c.asm_pushpop('push', 'constant', 7)
+        self.assertEqual(c.asm_label('LOOP'), '@SP\nM=M+1\nA=M-1\nM=D\n(Foo$LOOP)\n')
+        c.asm_pushpop('push', 'constant', 0)
+        self.assertEqual(c.asm_if('LOOP'), '@Foo$LOOP\nD; JNE\n')
+        self.assertEqual(c.flush(), '')
+
+    def test_end_of_file_flushes(self):
+        asm = translate('push constant 5\n', 'Foo.asm', init=False, top_in_d=True)
+        self.assertTrue(asm.endswith('@5\nD=A\n@SP\nM=M+1\nA=M-1\nM=D\n'))
+
+class SharedRoutinesTest(unittest.TestCase):
+    def test_call_sites_jump_to_shared_routines(self):
+        c = CodeWriter('Foo', shared_routines=True)
+        self.assertEqual(c.asm_call('Foo.bar', 2), '@Foo.bar\nD=A\n@R13\nM=D\n@7\nD=A\n@R14\nM=D\n' \
+                                                  '@Foo$ret.1\nD=A\n@$CALL\n0;JMP\n(Foo$ret.1)')
+        self.assertEqual(c.asm_return(), '@$RETURN\n0;JMP\n')
+        self.assertEqual(c.asm_arithmetic('lt'), '@COMPARE_RETURN_Foo.0\nD=A\n@$COMPARE_LT\n0;JMP\n(COMPARE_RETURN_Foo.0)\n')
+
+    def test_routines_emitted_once_by_init(self):
+        asm = translate('call Foo.bar 0\nreturn\nreturn\neq\n', 'Foo.asm', shared_routines=True)
+        for label in ('($CALL)', '($RETURN)', '($COMPARE_EQ)', '($COMPARE_GT)', '($COMPARE_LT)'):
+            self.assertEqual(asm.count(label), 1)
+
+class OptimizerTest(unittest.TestCase):
+    def optimized(self, *lines):
+        return list(optimize(parseLines(lines)))
+
+    def test_fold_constants(self):
+        self.assertEqual(self.optimized('push constant 2', 'push constant 3', 'add', 'push constant 1', 'sub'),
+                        [Command('C_PUSH', 'push', 'constant', 4)])
+        self.assertEqual(self.optimized('push constant 0', 'not', 'push constant 7', 'and'),
+                        [Command('C_PUSH', 'push', 'constant', 7)])
+
+    def test_fold_comparisons_like_the_generated_code(self):
+        self.assertEqual(self.optimized('push constant 3', 'push constant 2', 'gt'), [Command('C_PUSH', 'push', 'constant', -1)])
+        #32767 - (-1) overflows to -32768, so the generated D;JGT does not jump
+        self.assertEqual(self.optimized('push constant 32767', 'push constant 1', 'neg', 'gt'),
+                        [Command('C_PUSH', 'push', 'constant', 0)])
+
+    def test_identities(self):
+        self.assertEqual(self.optimized('push local 0', 'push constant 0', 'sub', 'neg', 'neg', 'not', 'not'),
+                        [Command('C_PUSH', 'push', 'LCL', 0)])
+
+    def test_fuse_push_pop(self):
+        self.assertEqual(self.optimized('push local 0', 'pop that 1', 'push static 2', 'pop static 2'),
+                        [Command('C_MOVE', 'move', ('LCL', 0), ('THAT', 1))])
+
+    def test_translate_optimized(self):
+        self.assertEqual(translate('push constant 1\nneg\npop temp 0\n', 'Foo.asm', init=False, optimize=True),
+                        "\n//push constant -1 / pop temp 0\nD=-1\n@R5\nM=D\n")
+        self.assertEqual(CodeWriter('Foo').asm_move(('constant', -300), ('LCL', 9)),
+                        '@9\nD=A\n@1\nD=M+D\n@R13\nM=D\n@299\nD=!A\n@R13\nA=M\nM=D\n')
+
+class CallOptimizationTest(unittest.TestCase):
+    main = ['function Main.max 0', 'push argument 0', 'push argument 1', 'gt', 'if-goto A', 'push argument 1',
+            'return', 'label A', 'push argument 0', 'return',
+            'function Main.count 1', 'push static 0', 'return',
+            'function Main.loop 0', 'push argument 0', 'push argument 1', 'call Main.loop 2', 'return']
+
+    def test_inline_leaf_function(self):
+        sys_vm = ['function Sys.init 0', 'push constant 1', 'push constant 2', 'call Main.max 2', 'call Main.count 0']
+        commands = optimize_calls([list(parseLines(sys_vm)), list(parseLines(self.main))])[0]
+        self.assertEqual([(c.type, c.arg2) for c in commands[3:]],
+                        [('C_INLINE_ENTER', 'Main.max'), ('C_PUSH', 'ARG'), ('C_PUSH', 'ARG'), ('C_ARITHMETIC', None),
+                        ('C_IF', 'A$inline.0'), ('C_PUSH', 'ARG'), ('C_INLINE_EXIT', 'Main.max'),
+                        ('C_GOTO', 'Main.max$return$inline.0'), ('C_LABEL', 'A$inline.0'), ('C_PUSH', 'ARG'),
+                        ('C_INLINE_EXIT', 'Main.max'), ('C_LABEL', 'Main.max$return$inline.0'),
+                        ('C_CALL', 'Main.count')]) #uses a static of another file, so it is still called
+        self.assertEqual(commands[3].arg3, (2, 0, False))
+
+    def test_size_limit(self):
+        sys_vm = ['function Sys.init 0', 'push constant 1', 'push constant 2', 'call Main.max 2']
+        commands = optimize_calls([list(parseLines(sys_vm)), list(parseLines(self.main))], limit=8)[0]
+        self.assertEqual(commands[-1], Command('C_CALL', 'call', 'Main.max', 2))
+
+    def test_tail_call(self):
+        commands = optimize_calls([list(parseLines(self.main))])[0]
+        self.assertEqual(commands[-1], Command('C_TAILCALL', 'call', 'Main.loop', (2, 2)))
+
+    def test_inline_flag_before_the_input(self):
+        translator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'VMTranslator.py')
+        with tempfile.TemporaryDirectory() as tmp:
+            prog = os.path.join(tmp, 'Prog')
+            os.mkdir(prog)
+            with open(os.path.join(prog, 'Sys.vm'), 'w') as f:
+                f.write('function Sys.init 0\npush constant 1\ncall Sys.f 1\nlabel END\ngoto END\n' \
+                        'function Sys.f 0\npush argument 0\nreturn\n')
+            log = os.path.join(tmp, 'VMTranslator.log')
+            for flags in (['--inline'], ['--inline', '--inline-limit', '2']):
+                result = subprocess.run([sys.executable, translator, '--no-cache', '--log', log, *flags, prog],
+                                        capture_output=True, text=True, timeout=60)
+                self.assertEqual(result.returncode, 0, result.stderr)
+                with open(os.path.join(prog, 'Prog.asm')) as f:
+                    self.assertNotIn('@Sys.f\n0;JMP', f.read())
+
+class PruneTest(unittest.TestCase):
+    def test_unreachable_functions_left_out(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'Sys.vm'), 'w') as f:
+                f.write('function Sys.init 0\ncall Math.abs 1\nlabel END\ngoto END\n')
+            with open(os.path.join(tmp, 'Math.vm'), 'w') as f:
+                f.write('function Math.abs 0\npush argument 0\nreturn\n' \
+                        'function Math.max 2\ncall Math.abs 1\nreturn\n')
+            stats = Stats(tmp)
+            with open(translatePath(tmp, stats=stats, options={'prune': True})) as f:
+                asm = f.read()
+        self.assertIn('(Math.abs)', asm)
+        self.assertNotIn('Math.max', asm)
+        self.assertEqual(stats.counters['functions_pruned'], 1)
+
+class ParallelTranslateTest(unittest.TestCase):
+    def test_jobs_give_the_same_output(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ('Sys', 'Main', 'Math'):
+                with open(os.path.join(tmp, name + '.vm'), 'w') as f:
+                    f.write(f'function {name}.f 0\npush static 0\npush constant 1\neq\nlabel L\nreturn\n')
+            outputs = []
+            for options in ({}, {'jobs': 2}, {'jobs': 2, 'prune': True}, {'prune': True}):
+                with open(translatePath(tmp, options=options)) as f:
+                    outputs.append(f.read())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[2], outputs[3])
+        self.assertLess(outputs[0].index('(Main.f)'), outputs[0].index('(Math.f)'))
+        self.assertLess(outputs[0].index('(Math.f)'), outputs[0].index('(Sys.f)'))
+        for name in ('Sys', 'Main', 'Math'):
+            self.assertIn(f'@{name}.0\n', outputs[0])
+            self.assertIn(f'(OUTPUT_TRUE_{name}.0)\n', outputs[0])
+            self.assertIn(f'({name}.f$L)\n', outputs[0])
+
+class LinkerTest(unittest.TestCase):
+    def test_link_matches_translate_and_assemble(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'Sys.vm'), 'w') as f:
+                f.write('function Sys.init 0\npush constant 3\ncall Main.f 1\npop static 0\nlabel END\ngoto END\n')
+            with open(os.path.join(tmp, 'Main.vm'), 'w') as f:
+                f.write('function Main.f 0\npush argument 0\npush static 1\nlt\nreturn\n')
+            for options in ({}, {'top_in_d': True}, {'shared_routines': True, 'optimize': True}):
+                with open(translatePath(tmp, options=options)) as f:
+                    expected = '\n'.join(hack_lines(assemble(f.read())))
+                stats = Stats(tmp)
+                with open(linkPath(tmp, stats, options)) as f:
+                    self.assertEqual(f.read(), expected)
+                self.assertEqual(stats.counters['objects_compiled'], 2)
+            with open(os.path.join(tmp, 'Main.vm'), 'a') as f:
+                f.write('function Main.g 0\npush constant 0\nreturn\n')
+            stats = Stats(tmp)
+            linkPath(tmp, stats, {'shared_routines': True, 'optimize': True})
+        self.assertEqual((stats.counters['objects_compiled'], stats.counters['objects_reused']), (1, 1))
+
+    def test_objects_depend_on_the_assembler(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'Sys.vm'), 'w') as f:
+                f.write('function Sys.init 0\nlabel END\ngoto END\n')
+            compiled = []
+            for version in ('1.0', '1.0', '1.1'):
+                stats = Stats(tmp)
+                with mock.patch('Linker.assembler_version', version):
+                    linkPath(tmp, stats)
+                compiled.append(stats.counters['objects_compiled'])
+        self.assertEqual(compiled, [1, 0, 1])
+
+class FusedTranslateTest(unittest.TestCase):
+    def test_hack_without_asm(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'Sys.vm'), 'w') as f:
+                f.write('function Sys.init 0\npush constant 3\ncall Sys.f 1\nlabel END\ngoto END\n' \
+                        'function Sys.f 0\npush argument 0\npush static 0\neq\nreturn\n')
+            for options in ({}, {'top_in_d': True, 'inline': 4}):
+                with open(translatePath(tmp, options=options)) as f:
+                    expected = '\n'.join(hack_lines(assemble(f.read())))
+                os.remove(os.path.join(tmp, os.path.basename(tmp) + '.asm'))
+                with open(translatePath(tmp, options=dict(options, hack=True))) as f:
+                    self.assertEqual(f.read(), expected)
+                self.assertFalse(os.path.exists(os.path.join(tmp, os.path.basename(tmp) + '.asm')))
+            translatePath(tmp, options={'hack': True, 'asm': True, 'jobs': 2})
+            self.assertTrue(os.path.exists(os.path.join(tmp, os.path.basename(tmp) + '.asm')))
+
+    def test_cached_hack_depends_on_the_assembler(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'Sys.vm'), 'w') as f:
+                f.write('function Sys.init 0\nlabel END\ngoto END\n')
+            cache = BuildCache(os.path.join(tmp, 'cache'))
+            hits = []
+            for version in ('1.0', '1.0', '1.1'):
+                stats = Stats(tmp)
+                with mock.patch('VMTranslator.assembler_version', version):
+                    translatePath(tmp, cache, stats, {'hack': True})
+                hits.append(stats.counters.get('cache_hits', 0))
+        self.assertEqual(hits, [0, 1, 0])
+
+class SourceMapTest(unittest.TestCase):
+    sys_vm = 'function Sys.init 0\npush constant 3\ncall Sys.f 1\nlabel END\ngoto END\n' \
+             'function Sys.f 0\npush argument 0\npush static 0\neq\nreturn\n'
+
+    def translate_map(self, options):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'Sys.vm'), 'w') as f:
+                f.write(self.sys_vm)
+            translatePath(tmp, options=dict(options, map=True))
+            name = os.path.join(tmp, os.path.basename(tmp))
+            asm = None
+            if os.path.exists(name + '.asm'):
+                with open(name + '.asm') as f:
+                    asm = f.read().split('\n')
+            return SourceMap.load(name + '.map'), asm
+
+    def test_addresses_map_to_asm_and_vm_lines(self):
+        source_map, asm = self.translate_map({})
+        words = assemble(asm)
+        self.assertEqual(source_map.words, len(words))
+        instruction_lines = [n for n, line in enumerate(asm, 1) if line.split('//')[0].strip() and line[0] != '(']
+        self.assertEqual([source_map.lookup(address)[0] for address in range(len(words))], instruction_lines)
+        eq = instruction_lines.index(asm.index('//eq') + 2)
+        self.assertEqual(source_map.lookup(eq)[1], ('Sys.vm', 9, 'Sys.f'))
+        self.assertIsNone(source_map.lookup(0)[1]) #startup code
+
+    def test_same_map_in_every_mode(self):
+        expected, _ = self.translate_map({'comments': False})
+        for options in ({'comments': False, 'jobs': 2}, {'hack': True}, {'hack': True, 'asm': True, 'comments': False}):
+            source_map, _ = self.translate_map(options)
+            self.assertEqual([source_map.lookup(address) for address in range(expected.words)],
+                             [expected.lookup(address) for address in range(expected.words)])
+
+    def test_inlined_code_maps_to_the_call(self):
+        source_map, asm = self.translate_map({'inline': 4})
+        origins = {source_map.lookup(address)[1] for address in range(source_map.words)}
+        self.assertIn(('Sys.vm', 3, 'Sys.init'), origins)
+        self.assertFalse(any(origin[2] == 'Sys.init' and origin[1] > 5 for origin in origins if origin))
+
+class VMInterpreterTest(unittest.TestCase):
+    sys_vm = ['function Sys.init 0', 'push constant 5', 'call Main.fact 1', 'pop static 0', 'label END', 'goto END']
+    main_vm = ['function Main.fact 1', 'push argument 0', 'push constant 1', 'gt', 'if-goto RECURSE',
+               'push constant 1', 'return', 'label RECURSE', 'push argument 0', 'push argument 0', 'push constant 1',
+               'sub', 'call Main.fact 1', 'call Main.multiply 2', 'return',
+               'function Main.multiply 1', 'push constant 0', 'pop local 0', 'label LOOP', 'push argument 1',
+               'if-goto ADD', 'push local 0', 'return', 'label ADD', 'push local 0', 'push argument 0', 'add',
+               'pop local 0', 'push argument 1', 'push constant 1', 'sub', 'pop argument 1', 'goto LOOP']
+
+    def test_runs_calls_and_scoped_labels(self):
+        vm = VMInterpreter([('Main.vm', self.main_vm), ('Sys.vm', self.sys_vm)])
+        vm.run()
+        self.assertTrue(vm.halted)
+        self.assertEqual(vm.variables, {'endframe': 16, 'retAddr': 17, 'Sys.0': 18})
+        self.assertEqual(vm.ram[18], 120)
+        self.assertEqual(vm.ram[:5], [261, 261, 256, 900, 1000])
+
+    def test_steps_and_arithmetic(self):
+        vm = VMInterpreter([('Foo.vm', ['push constant 32767', 'push constant 1', 'add', 'push constant 3',
+                                        'lt', 'not', 'pop temp 2'])], init=False)
+        self.assertEqual(vm.run(3), 3)
+        self.assertEqual(vm.ram[256], -32768)
+        vm.run()
+        #-32768 - 3 overflows to 32765, so lt is false exactly as in the translated code
+        self.assertEqual((vm.ram[7], vm.ram[0], vm.halted), (-1, 256, True))
+
+    def test_undefined_label(self):
+        with self.assertRaises(ValueError):
+            VMInterpreter([('Foo.vm', ['function Foo.f 0', 'label A', 'function Foo.g 0', 'goto A'])])
+
+    def test_runtime_errors_name_the_command(self):
+        vm = VMInterpreter([('Sys.vm', ['function Sys.init 0', 'push constant 1', 'call Sys.init 0'])])
+        with self.assertRaisesRegex(ValueError, 'stack overflow at command 4, line 3: call Sys.init 0'):
+            vm.run()
+        self.assertEqual((vm.pc, len(vm.ram)), (4, 0x8000))
+        vm = VMInterpreter([('Foo.vm', ['push constant 1', 'pop pointer 1', 'push that 40000'])], init=False)
+        with self.assertRaisesRegex(ValueError, 'address outside RAM at command 2, line 3: push that 40000'):
+            vm.run()
+        vm = VMInterpreter([('Foo.vm', ['push constant 5', 'pop that 0'])], init=False)
+        vm.ram[4] = -3
+        with self.assertRaisesRegex(ValueError, 'address outside RAM at command 1, line 2: pop that 0'):
+            vm.run()
+        self.assertEqual(vm.ram[-3:], [0, 0, 0])
+
+class AssemblerParallelTest(unittest.TestCase):
+    def test_same_words_and_symbols_as_serial(self):
+        program = ['(START)', '@i', 'M=1 // one', '', '(LOOP)', '@i', 'D=M', '@END', 'D;JGT', '@sum', 'M=D+M',
+                   '@LOOP', '0;JMP', '(END)', '@END', '0;JMP'] * 5
+        program = [line + '\n' for line in program]
+        serial, parallel = SymbolTable(), SymbolTable()
+        with mock.patch('assembler.PARALLEL_MIN_LINES', 0), mock.patch('assembler.PARALLEL_CHUNK_LINES', 7):
+            words = assemble_parallel(program, parallel, 2)
+        self.assertEqual(words, assemble(program, serial))
+        self.assertEqual(parallel.user_symbols(), serial.user_symbols())
+
+class BuildCacheTest(unittest.TestCase):
+    clock = 1000000
+    def store(self, cache, tmp, name, text):
+        out = os.path.join(tmp, name + '.hack')
+        with open(out, 'w') as f:
+            f.write(text)
+        key = cache.key('assembler', '1.0', {}, name)
+        cache.store(key, [out])
+        os.utime(cache.entry(key, out), (self.clock, self.clock)) #store order, whatever the mtime resolution
+        self.clock += 1
+        return key, out
+
+    def test_vanished_entry_is_a_miss(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = BuildCache(os.path.join(tmp, 'cache'))
+            key, out = self.store(cache, tmp, 'Max', '0000000000000010\n')
+            with mock.patch('BuildCache.shutil.copyfile', side_effect=FileNotFoundError):
+                self.assertFalse(cache.restore(key, [out]))
+
+    def test_evicts_only_past_max_bytes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = BuildCache(os.path.join(tmp, 'cache'), max_bytes=40)
+            with mock.patch.object(cache, 'evict', wraps=cache.evict) as evict:
+                keys = [self.store(cache, tmp, name, '0' * 10)[0] for name in ('A', 'B', 'C')]
+                self.assertEqual(evict.call_count, 1) #the first store counts the empty cache
+                keys.append(self.store(cache, tmp, 'D', '0' * 20)[0])
+                self.assertEqual(evict.call_count, 2)
+            left = [key for key in keys if os.path.exists(cache.entry(key, 'x.hack'))]
+            self.assertEqual(left, keys[2:]) #oldest first, down to 30 bytes
+            self.assertEqual(cache.usage(), 30)
+
+class AssemblerBatchTest(unittest.TestCase):
+    assembler = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Assembler', 'code', 'assembler.py')
+
+    def test_missing_file_in_jobs_batch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            good, missing = os.path.join(tmp, 'Good.asm'), os.path.join(tmp, 'Missing.asm')
+            with open(good, 'w') as f:
+                f.write('@2\nD=A\n')
+            for cache in (['--no-cache'], ['--cache-dir', os.path.join(tmp, 'cache')]):
+                result = subprocess.run([sys.executable, self.assembler, *cache, '--jobs', '2', '--log',
+                                         os.path.join(tmp, 'assembler.log'), good, missing],
+                                        capture_output=True, text=True, timeout=60)
+                self.assertTrue(os.path.exists(os.path.join(tmp, 'Good.hack')))
+                self.assertEqual(result.returncode, 1)
+                self.assertIn(f'{missing}: failed', result.stdout)
+                self.assertIn('1 files, 2 words', result.stdout)
+                self.assertNotIn('Traceback', result.stderr)
+
+    def test_batch_stats_are_json_lines(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ('A', 'B'):
+                with open(os.path.join(tmp, name + '.asm'), 'w') as f:
+                    f.write('@2\nD=A\n')
+            result = subprocess.run([sys.executable, self.assembler, '--no-cache', '--stats', '--log',
+                                     os.path.join(tmp, 'assembler.log'), tmp, os.path.join(tmp, 'Missing.asm')],
+                                    capture_output=True, text=True, timeout=60)
+        reports = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual([report['counters']['words'] for report in reports], [2, 2])
+        self.assertIn('2 files, 4 words', result.stderr)
+
+class TranslateFileStatsTest(unittest.TestCase):
+    def test_stats_phases_and_counters(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            inf = os.path.join(tmp, 'Foo.vm')
+            with open(inf, 'w') as f:
+                f.write('push constant 1\npush constant 2\nadd\n// done\n')
+            stats, plain = Stats(inf), StringIO()
+            outf = StringIO()
+            translateFile(CodeWriter('Foo.asm'), inf, outf, stats)
+            translateFile(CodeWriter('Foo.asm'), inf, plain)
+        self.assertEqual(outf.getvalue(), plain.getvalue())
+        report = stats.report()
+        self.assertEqual(set(report['phases']), {'read', 'parse', 'codegen', 'write'})
+        self.assertEqual(report['counters'], {'lines': 4, 'C_PUSH': 2, 'C_ARITHMETIC': 1})
+
+    def test_jobs_hack_and_map_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ('Sys', 'Main'):
+                with open(os.path.join(tmp, name + '.vm'), 'w') as f:
+                    f.write(f'function {name}.f 0\npush constant 1\nreturn\n')
+            for options in ({'jobs': 2}, {'map': True}, {'map': True, 'jobs': 2}, {'hack': True},
+                            {'hack': True, 'asm': True, 'jobs': 2}):
+                stats = Stats(tmp)
+                translatePath(tmp, stats=stats, options=options)
+                report = stats.report()
+                self.assertTrue({'parse', 'codegen', 'write'} <= set(report['phases']), options)
+                self.assertNotIn('translate', report['phases'])
+                self.assertEqual((report['counters']['lines'], report['counters']['C_PUSH']), (6, 2))
+
+    def test_whole_program_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'Sys.vm'), 'w') as f:
+                f.write('function Sys.init 0\npush constant 1\ncall Sys.f 1\nlabel END\ngoto END\n' \
+                        'function Sys.f 0\npush argument 0\nreturn\n')
+            for options in ({'prune': True}, {'inline': 4}, {'prune': True, 'jobs': 2}):
+                stats = Stats(tmp)
+                translatePath(tmp, stats=stats, options=options)
+                report = stats.report()
+                self.assertTrue({'parse', 'codegen', 'write'} <= set(report['phases']))
+                self.assertEqual(report['counters']['lines'], 8)
+                self.assertEqual(report['counters']['C_GOTO'], 1)
+            self.assertEqual(report['counters']['C_CALL'], 1)
+            self.assertEqual(report['counters']['C_FUNCTION'], 2)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file